@@ -0,0 +1,111 @@
+"""
+Compact archives of finished games.
+
+Once a completed or abandoned game has been idle for ARCHIVE_AFTER_MINUTES
+(long enough for its drawings to be mirrored), its play order, players and
+gallery chains are stored as one compressed JSON document in game_archives and
+its rounds and players rows are deleted, keeping the hot tables down to games
+still being played. The games row stays so the id isn't reused until
+recycle_game_ids frees it, and galleries read from the archive.
+
+    python archive.py                   # archive every eligible finished game
+    python archive.py --min-age 0       # including games that just finished
+"""
+
+import argparse
+import datetime as dt
+import logging
+import os
+from collections import defaultdict
+
+from dotenv import load_dotenv
+from sqlalchemy.orm import selectinload
+
+import gallery
+import model
+from database import db
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_AFTER_MINUTES = int(os.environ.get("ARCHIVE_AFTER_MINUTES", 60))
+ARCHIVE_BATCH_SIZE = 200
+
+
+def build_document(game, rows):
+    chains, _ = gallery.chains_from_rounds(game.routing, rows)
+    return {
+        "play_order": game.play_order,
+        "turn_index": game.turn_index,
+        "players": [
+            {"id": p.id, "phone": p.phone, "is_host": p.is_host, "nickname": p.nickname}
+            for p in game.players
+        ],
+        "chains": chains,
+    }
+
+
+def archive_games(min_age_minutes=ARCHIVE_AFTER_MINUTES):
+    """Archive one batch of eligible games, returning their ids."""
+    cutoff = dt.datetime.utcnow() - dt.timedelta(minutes=min_age_minutes)
+    games = (
+        model.Game.query.options(selectinload(model.Game.players))
+        .filter(
+            model.Game.status.in_(model.FINISHED_STATUSES),
+            model.Game.last_activity_at < cutoff,
+            ~model.Game.archive.has(),
+        )
+        .limit(ARCHIVE_BATCH_SIZE)
+        .all()
+    )
+    if not games:
+        return []
+    ids = [game.id for game in games]
+    rows = defaultdict(list)
+    for game_id, *row in gallery.round_rows(ids):
+        rows[game_id].append(row)
+    try:
+        db.session.add_all(
+            model.GameArchive(
+                game_id=game.id,
+                archived_at=dt.datetime.utcnow(),
+                document=model.GameArchive.pack(build_document(game, rows[game.id])),
+            )
+            for game in games
+        )
+        db.session.flush()
+        for table in (model.GameRound, model.GamePlayer):
+            table.query.filter(table.game_id.in_(ids)).delete(synchronize_session=False)
+        db.session.commit()
+    except:
+        db.session.rollback()
+        raise
+    return ids
+
+
+def backfill(min_age_minutes=ARCHIVE_AFTER_MINUTES):
+    archived = 0
+    while True:
+        ids = archive_games(min_age_minutes)
+        if not ids:
+            break
+        archived += len(ids)
+        logger.info(f"archived {archived} games")
+    return archived
+
+
+if __name__ == "__main__":
+    from server import create_app
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--min-age",
+        type=int,
+        default=ARCHIVE_AFTER_MINUTES,
+        help="minutes since a game's last activity",
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    create_app().app_context().push()
+    print(f"archived {backfill(args.min_age)} games")
@@ -0,0 +1,84 @@
+"""
+The shared SQLAlchemy instance, with optional read-replica routing.
+
+When the app is configured with a "replica" bind (DATABASE_REPLICA_PATH),
+queries made inside replica_reads() go to the replica and everything else
+goes to the primary. A session that has flushed a write sticks to the primary
+until it is closed, so it always reads its own writes, and primary() pins a
+block to the primary outright, for reads that must see a write made by an
+earlier request. Without a replica both are no-ops.
+"""
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from flask_sqlalchemy import SignallingSession, SQLAlchemy
+from sqlalchemy import event, orm
+
+REPLICA_BIND = "replica"
+
+_use_replica = ContextVar("use_replica", default=False)
+
+
+@contextmanager
+def replica_reads():
+    """Send this block's queries to the replica, if there is one."""
+    token = _use_replica.set(True)
+    try:
+        yield
+    finally:
+        _use_replica.reset(token)
+
+
+@contextmanager
+def primary():
+    """Keep this block's queries on the primary, even inside replica_reads()."""
+    token = _use_replica.set(False)
+    try:
+        yield
+    finally:
+        _use_replica.reset(token)
+
+
+def has_replica(app):
+    return REPLICA_BIND in (app.config.get("SQLALCHEMY_BINDS") or {})
+
+
+class RoutingSession(SignallingSession):
+    def __init__(self, db, **options):
+        super().__init__(db, **options)
+        self._db = db
+        self.wrote = False
+
+    def get_bind(self, mapper=None, clause=None):
+        if clause is not None and (
+            getattr(clause, "is_dml", False)
+            or getattr(clause, "_for_update_arg", None) is not None
+        ):
+            # bulk UPDATE/DELETE and locking reads
+            self.wrote = True
+        if (
+            _use_replica.get()
+            and not self.wrote
+            and not self._flushing
+            and has_replica(self.app)
+        ):
+            return self._db.get_engine(self.app, bind=REPLICA_BIND)
+        return super().get_bind(mapper, clause)
+
+    def close(self):
+        super().close()
+        self.wrote = False
+
+
+@event.listens_for(RoutingSession, "after_flush")
+def _pin_to_primary(session, flush_context):
+    session.wrote = True
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+db = RoutingSQLAlchemy()
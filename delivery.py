@@ -0,0 +1,219 @@
+"""
+Delivery receipts for round prompts.
+
+Prompts are sent with a status callback pointing at /sms/status?round_id=...
+Each callback is only pushed onto a Redis list, and a periodic task drains the
+list and applies the newest status per round in one bulk UPDATE per status, so
+a round start costs a handful of statements rather than a task and a commit
+per message.
+
+The sid Twilio returns for each prompt goes on the same list when it is sent,
+so the round's prompt_sid always names the latest message and receipts for a
+message it has since re-sent are ignored. A re-send sets prompt_sid to
+AWAITING_SID until the new message's sid is applied. A prompt whose send
+raised is buffered as failed under AWAITING_SID, so it is re-sent too.
+"""
+
+import json
+import logging
+import os
+import re
+
+import redis
+from dotenv import load_dotenv
+from sqlalchemy import bindparam, case, literal, or_
+
+import model
+from database import db
+from store import get_redis
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+STATUS_CALLBACK_URL = os.environ.get("STATUS_CALLBACK_URL") or (
+    f"{os.environ['EIP']}/sms/status" if os.environ.get("EIP") else None
+)
+PENDING_KEY = "delivery:pending"
+DRAIN_BATCH_SIZE = 5000
+MESSAGE_SID = re.compile(r"^(SM|MM)[0-9a-f]{32}$")
+# prompt_sid while a re-sent prompt's new sid is on its way; matches no receipt
+AWAITING_SID = ""
+
+# Twilio message statuses in the order they progress; the last three are final
+# and rank equally.
+# A callback never moves a round back to an earlier status, since callbacks can
+# arrive out of order.
+STATUS_ORDER = [
+    "accepted",
+    "queued",
+    "sending",
+    "sent",
+    "delivered",
+    "undelivered",
+    "failed",
+]
+UNDELIVERED_STATUSES = ["undelivered", "failed"]
+IN_FLIGHT_STATUSES = ["accepted", "queued", "sending"]
+
+
+def rank(status):
+    return min(STATUS_ORDER.index(status), STATUS_ORDER.index("delivered"))
+
+
+def callback_url(round_id):
+    if not STATUS_CALLBACK_URL:
+        return None
+    return f"{STATUS_CALLBACK_URL}?round_id={round_id}"
+
+
+def record(round_id, sid, status):
+    """Buffer one status callback until the next flush."""
+    if status not in STATUS_ORDER or not MESSAGE_SID.match(sid or ""):
+        return
+    entry = {"round_id": round_id, "sid": sid, "status": status}
+    try:
+        get_redis().rpush(PENDING_KEY, json.dumps(entry))
+    except redis.RedisError:
+        logger.exception("could not buffer delivery status")
+
+
+def record_sent(sends):
+    """Buffer the sids of prompts just sent, as (round_id, sid) pairs."""
+    entries = [
+        json.dumps({"round_id": round_id, "sent_sid": sid})
+        for round_id, sid in sends
+        if MESSAGE_SID.match(sid or "")
+    ]
+    if not entries:
+        return
+    try:
+        get_redis().rpush(PENDING_KEY, *entries)
+    except redis.RedisError:
+        logger.exception("could not buffer prompt sids")
+
+
+def record_failed(round_ids):
+    """
+    Buffer prompts whose send raised, as failed, so they are re-sent like any
+    other undelivered prompt.
+    """
+    entries = [
+        json.dumps({"round_id": round_id, "sid": AWAITING_SID, "status": "failed"})
+        for round_id in round_ids
+    ]
+    if not entries:
+        return
+    try:
+        get_redis().rpush(PENDING_KEY, *entries)
+    except redis.RedisError:
+        logger.exception("could not buffer failed prompts")
+
+
+def drain():
+    """Pop up to DRAIN_BATCH_SIZE buffered entries."""
+    pipe = get_redis().pipeline()
+    pipe.lrange(PENDING_KEY, 0, DRAIN_BATCH_SIZE - 1)
+    pipe.ltrim(PENDING_KEY, DRAIN_BATCH_SIZE, -1)
+    entries, _ = pipe.execute()
+    return entries
+
+
+def coalesce(entries):
+    """
+    Keep the newest sid sent for each round, and the furthest-along status for
+    each (round, message). Entries that can't be parsed are dropped.
+    """
+    sent = {}
+    latest = {}
+    for entry in entries:
+        try:
+            entry = json.loads(entry)
+            round_id = int(entry["round_id"])
+            if "sent_sid" in entry:
+                sent[round_id] = entry["sent_sid"]
+                continue
+            key = (round_id, entry["sid"])
+            status = entry["status"]
+            rank(status)
+        except (ValueError, KeyError, TypeError):
+            logger.warning(f"dropping malformed delivery entry {entry!r}")
+            continue
+        if key not in latest or rank(status) > rank(latest[key]):
+            latest[key] = status
+    return sent, latest
+
+
+def apply(sent, latest):
+    """
+    Record sent sids, then write coalesced statuses, one executemany UPDATE
+    per status.
+    """
+    rounds = model.GameRound.__table__
+    if sent:
+        db.session.execute(
+            rounds.update()
+            .where(rounds.c.id == bindparam("round_id"))
+            .values(
+                prompt_sid=bindparam("sid"),
+                # a receipt for this message may already have been applied
+                prompt_status=case(
+                    (rounds.c.prompt_sid == bindparam("sid"), rounds.c.prompt_status),
+                    else_=None,
+                ),
+                prompt_sent=case(
+                    (rounds.c.prompt_sid == bindparam("sid"), rounds.c.prompt_sent),
+                    else_=False,
+                ),
+            ),
+            [{"round_id": round_id, "sid": sid} for round_id, sid in sent.items()],
+        )
+    by_status = {}
+    for (round_id, sid), status in latest.items():
+        by_status.setdefault(status, []).append({"round_id": round_id, "sid": sid})
+    for status, params in by_status.items():
+        earlier = [s for s in STATUS_ORDER if rank(s) < rank(status)]
+        db.session.execute(
+            rounds.update().where(rounds.c.id == bindparam("round_id"))
+            # ignore receipts for a prompt that has since been re-sent
+            .where(
+                or_(
+                    rounds.c.prompt_sid.is_(None),
+                    rounds.c.prompt_sid == bindparam("sid"),
+                )
+            )
+            .where(
+                or_(
+                    rounds.c.prompt_status.is_(None),
+                    # literals, since executemany can't expand a parameter
+                    rounds.c.prompt_status.in_([literal(s) for s in earlier]),
+                )
+            )
+            .values(
+                prompt_sid=bindparam("sid"),
+                prompt_status=status,
+                prompt_sent=status in ("sent", "delivered"),
+            ),
+            params,
+        )
+    db.session.commit()
+
+
+def flush():
+    """Apply everything buffered so far, returning how many entries."""
+    applied = 0
+    while True:
+        entries = drain()
+        if not entries:
+            break
+        try:
+            apply(*coalesce(entries))
+        except:
+            db.session.rollback()
+            # the database failed; put them back for the next flush
+            get_redis().rpush(PENDING_KEY, *entries)
+            raise
+        applied += len(entries)
+        if len(entries) < DRAIN_BATCH_SIZE:
+            break
+    return applied
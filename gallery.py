@@ -0,0 +1,110 @@
+"""
+Gallery pages for finished games.
+
+Galleries are built from a single query over a game's rounds, or from its
+archive once the rounds have been compacted (see archive.py). A completed
+game's gallery never changes, so it is cached in memory and also rendered
+once to a static file under GALLERY_ROOT, which nginx serves directly.
+"""
+import logging
+import os
+import shutil
+from collections import OrderedDict
+
+from dotenv import load_dotenv
+from flask import render_template
+
+import model
+from database import db
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+GALLERY_ROOT = os.environ.get(
+    "GALLERY_ROOT",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "galleries"),
+)
+GALLERY_CACHE_SIZE = int(os.environ.get("GALLERY_CACHE_SIZE", 256))
+_gallery_cache = OrderedDict()
+
+
+def chains_from_rounds(routing, rows):
+    """Arrange (player, round_number, data, media_file, turn_type) rows into
+    chains, returning them and whether every drawing has been mirrored."""
+    chains = [
+        [chain] + [None] * len(order) for chain, order in enumerate(routing.play_order)
+    ]
+    all_mirrored = True
+    for player, round_number, data, media_file, turn_type in rows:
+        player_chains = routing.index.get(player, [])
+        if round_number >= len(player_chains) or player_chains[round_number] is None:
+            # a row play_order doesn't route, e.g. from a game seeded without one
+            logger.warning(f"skipping unroutable round {round_number} of {player}")
+            continue
+        if media_file:
+            data = f"/media/{media_file}"
+        elif turn_type == model.TurnType.DRAW:
+            all_mirrored = False
+        chains[player_chains[round_number]][round_number + 1] = data
+    return chains, all_mirrored
+
+
+def round_rows(game_ids):
+    """Query the rows chains_from_rounds needs, with the game id first."""
+    return db.session.query(
+        model.GameRound.game_id,
+        model.GameRound.player,
+        model.GameRound.round_number,
+        model.GameRound.data,
+        model.GameRound.media_file,
+        model.GameRound.turn_type,
+    ).filter(model.GameRound.game_id.in_(game_ids))
+
+
+def generate_gallery(game):
+    """Build the gallery chains for a game from its archive, or else from a
+    single query over its rounds.
+
+    Galleries for completed games never change, so they are kept in a
+    size-capped LRU cache. The key includes created_at since ids are reused.
+    """
+    key = (game.id, game.created_at)
+    if key in _gallery_cache:
+        _gallery_cache.move_to_end(key)
+        return _gallery_cache[key]
+
+    if game.archive:
+        data, cacheable = game.archive.load()["chains"], True
+    else:
+        rows = [row[1:] for row in round_rows([game.id])]
+        data, all_mirrored = chains_from_rounds(game.routing, rows)
+        # cache once drawings are served locally, since mirroring finishes later
+        cacheable = game.status == model.Status.COMPLETED and all_mirrored
+
+    if cacheable:
+        _gallery_cache[key] = data
+        if len(_gallery_cache) > GALLERY_CACHE_SIZE:
+            _gallery_cache.popitem(last=False)
+    return data
+
+
+def static_path(game_id):
+    return os.path.join(GALLERY_ROOT, game_id, "index.html")
+
+
+def render_static(game):
+    """Write a completed game's gallery page where nginx will find it."""
+    html = render_template("gallery.html", data=generate_gallery(game))
+    path = static_path(game.id)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # write then rename so nginx never serves a partial page
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(html)
+    os.replace(tmp_path, path)
+
+
+def remove_static(game_ids):
+    for game_id in game_ids:
+        shutil.rmtree(os.path.join(GALLERY_ROOT, game_id), ignore_errors=True)
@@ -0,0 +1,86 @@
+"""
+Game ID allocation.
+
+IDs are four letters without vowels. Rather than drawing random IDs and
+probing the database for collisions, every ID is the image of a counter value
+under a fixed permutation of the whole ID space, so a shared Redis counter
+hands out a fresh ID with a single atomic INCR. IDs from finished games go on
+a free list once they are past the retention window and are handed out first.
+
+If Redis loses the counter or rolls it back, allocated IDs start colliding
+with games that already exist; on a collision the caller reseeds the counter
+past the highest counter value a game was allocated from and tries again.
+Recycled IDs and IDs from before the counter don't count, since they can lie
+anywhere in the space.
+"""
+import os
+import string
+
+from store import get_redis
+
+LETTERS = sorted(set(string.ascii_letters) - set("aeiouAEIOU"))
+ID_LENGTH = 4
+ID_SPACE = len(LETTERS) ** ID_LENGTH
+
+# STRIDE is prime and doesn't divide ID_SPACE (2^4 * 3^4 * 7^4), so
+# n -> n * STRIDE + OFFSET visits every ID exactly once before repeating.
+STRIDE = 1000003
+OFFSET = int(os.environ.get("GAME_ID_OFFSET", 918273))
+
+COUNTER_KEY = "game_ids:counter"
+FREE_KEY = "game_ids:free"
+
+# KEYS[1]: the counter. ARGV[1]: the lowest value it may have.
+RAISE_SCRIPT = """
+local current = tonumber(redis.call('GET', KEYS[1]) or '0')
+if current < tonumber(ARGV[1]) then
+  redis.call('SET', KEYS[1], ARGV[1])
+end
+"""
+
+_raise = None
+
+
+class GameIdsExhausted(Exception):
+    pass
+
+
+def id_for_index(n):
+    n = (n * STRIDE + OFFSET) % ID_SPACE
+    chars = []
+    for _ in range(ID_LENGTH):
+        n, r = divmod(n, len(LETTERS))
+        chars.append(LETTERS[r])
+    return "".join(chars)
+
+
+def allocate():
+    """
+    Returns (id, counter value), the counter value being None for a recycled ID.
+    """
+    redis = get_redis()
+    recycled = redis.lpop(FREE_KEY)
+    if recycled:
+        return recycled, None
+    n = redis.incr(COUNTER_KEY) - 1
+    if n >= ID_SPACE:
+        raise GameIdsExhausted("No unused game ids left and none have been released.")
+    return id_for_index(n), n
+
+
+def release(ids):
+    if ids:
+        get_redis().rpush(FREE_KEY, *ids)
+
+
+def reseed(last_index):
+    """
+    Move the counter past the highest value it is known to have handed out,
+    after Redis has lost or rolled it back. Never moves it backwards.
+    """
+    global _raise
+    if last_index is None:
+        return
+    if _raise is None:
+        _raise = get_redis().register_script(RAISE_SCRIPT)
+    _raise(keys=[COUNTER_KEY], args=[last_index + 1])
@@ -0,0 +1,14 @@
+import multiprocessing
+import os
+
+bind = os.environ.get("GUNICORN_BIND", "127.0.0.1:5000")
+workers = int(os.environ.get("GUNICORN_WORKERS", multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.environ.get("GUNICORN_THREADS", 1))
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", 30))
+
+# Load the app in each worker after forking so database pools are never
+# shared between processes.
+preload_app = False
+
+accesslog = "-"
+errorlog = "-"
@@ -0,0 +1,330 @@
+"""
+Write-behind state for games in progress, kept in Redis (HOT_STATE=true).
+
+Once a game is IN_PROGRESS its roster, current round and the responses sent in
+it live in Redis, so a response is recorded with one script call (HSETNX, so
+only a player's first response counts) instead of a locked UPDATE and commit.
+The same call tells exactly one response that it finished the round. Responses
+are written to their rounds rows by flush(), which runs for that game as soon
+as a round is finished and for every game with unwritten responses each
+HOT_STATE_FLUSH_SECONDS. flush() decides round ends from the database
+rather than from Redis, so a response that fell back to the SQL path while
+Redis was unreachable still counts.
+
+Round starts reload a game's state from the database. If Redis loses it, the
+next text from the game rebuilds it from there as well. Only responses sent
+since the last flush can be lost that way. Without HOT_STATE everything here
+is a no-op and texts go through the database as before.
+"""
+
+import json
+import logging
+import os
+
+import redis
+from dotenv import load_dotenv
+from sqlalchemy import bindparam
+
+import model
+import status_cache
+import tracing
+from database import db
+from store import get_redis
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+ENABLED = os.environ.get("HOT_STATE", "false").lower() == "true"
+HOT_STATE_FLUSH_SECONDS = float(os.environ.get("HOT_STATE_FLUSH_SECONDS", 5))
+# reloaded every round, so this only bounds how long an abandoned entry lingers
+HOT_STATE_TTL = int(os.environ.get("HOT_STATE_TTL", 24 * 60 * 60))
+DIRTY_KEY = "hot:dirty"
+
+# texts that are commands rather than responses while a round is being played
+COMMANDS = ["status", "leave", "repeat prompt", "resend prompt"]
+
+# outcomes of respond()
+MISS = "miss"
+RECORDED = "recorded"
+IGNORED = "ignored"
+
+# KEYS[1]: the phone's pointer, KEYS[2]: the dirty set. ARGV: phone, response.
+# Returns [outcome, game_id, round, players].
+RESPOND_SCRIPT = """
+local game_id = redis.call('GET', KEYS[1])
+if not game_id then return {'miss'} end
+local game = 'hot:game:' .. game_id
+local player = redis.call('HGET', game .. ':players', ARGV[1])
+local state = redis.call('HMGET', game, 'current_round', 'players', 'open')
+local round, players = state[1], state[2]
+if not player or not round then return {'miss'} end
+if state[3] ~= '1' then return {'ignored', game_id, round, players} end
+local responses = game .. ':round:' .. round
+if redis.call('HSETNX', responses, player, ARGV[2]) == 0 then
+  return {'ignored', game_id, round, players}
+end
+redis.call('HINCRBY', game, 'version', 1)
+redis.call('SADD', KEYS[2], game_id)
+if redis.call('HLEN', responses) < tonumber(players) then
+  return {'recorded', game_id, round, players}
+end
+redis.call('HSET', game, 'current_round', tonumber(round) + 1, 'open', '0')
+return {'round_over', game_id, round, players}
+"""
+
+# KEYS[1]: the game, KEYS[2]: the dirty set. ARGV: version flushed, game id.
+# Leaves the game dirty if a response came in during the flush.
+MARK_CLEAN_SCRIPT = """
+if (redis.call('HGET', KEYS[1], 'version') or '0') == ARGV[1] then
+  return redis.call('SREM', KEYS[2], ARGV[2])
+end
+return 0
+"""
+
+_respond = None
+_mark_clean = None
+
+
+def _game_key(game_id):
+    return f"hot:game:{game_id}"
+
+
+def _round_key(game_id, round_number):
+    return f"hot:game:{game_id}:round:{round_number}"
+
+
+def _phone_key(phone):
+    return f"hot:phone:{phone}"
+
+
+def is_response(body, media):
+    if media and body:
+        return False
+    return body.lower() not in COMMANDS
+
+
+def load(game, missing_only=False):
+    """
+    Write a game's state from the database: its roster, current round and the
+    responses already recorded in it.
+
+    With missing_only, leaves state that is already there alone, so a rebuild
+    racing a response can't drop it.
+    """
+    if not ENABLED:
+        return
+    key = _game_key(game.id)
+    round_key = _round_key(game.id, game.current_round)
+    rounds = game.current_rounds
+    try:
+        with get_redis().pipeline() as pipe:
+            pipe.watch(key)
+            if missing_only and pipe.exists(key):
+                return
+            pipe.multi()
+            pipe.hset(
+                key,
+                mapping={
+                    "current_round": game.current_round,
+                    "players": len(game.players),
+                    # responses only count once the round's rows exist
+                    "open": "1" if rounds else "0",
+                },
+            )
+            pipe.delete(f"{key}:players", round_key)
+            pipe.hset(f"{key}:players", mapping={p.phone: p.id for p in game.players})
+            responses = {
+                r.player: json.dumps([r.turn_type.name, r.data])
+                for r in rounds
+                if r.data is not None
+            }
+            if responses:
+                pipe.hset(round_key, mapping=responses)
+            for player in game.players:
+                pipe.set(_phone_key(player.phone), game.id, ex=HOT_STATE_TTL)
+            for k in (key, f"{key}:players", round_key):
+                pipe.expire(k, HOT_STATE_TTL)
+            pipe.execute()
+    except redis.WatchError:
+        # loaded by someone else in the meantime
+        pass
+    except redis.RedisError:
+        logger.exception(f"could not load hot state for game {game.id}")
+
+
+def evict(game_id):
+    """Drop a game's state once it has finished or been abandoned."""
+    if not ENABLED:
+        return
+    key = _game_key(game_id)
+    try:
+        client = get_redis()
+        phones = client.hkeys(f"{key}:players")
+        current_round = int(client.hget(key, "current_round") or 0)
+        pipe = client.pipeline()
+        pipe.delete(
+            key,
+            f"{key}:players",
+            _round_key(game_id, current_round),
+            _round_key(game_id, current_round - 1),
+            # a player may have moved on to another game already
+            *[_phone_key(p) for p in phones if client.get(_phone_key(p)) == game_id],
+        )
+        pipe.srem(DIRTY_KEY, game_id)
+        pipe.execute()
+    except redis.RedisError:
+        logger.exception(f"could not evict hot state for game {game_id}")
+
+
+def respond(phone, body, media):
+    """
+    Record a response for the player's current round.
+
+    Returns RECORDED, IGNORED if the player already responded or the round is
+    over, or MISS if there's no state for the phone (or Redis is unavailable)
+    and the text should be handled from the database.
+    """
+    import tasks
+
+    global _respond
+    type_ = model.TurnType.DRAW if media else model.TurnType.WRITE
+    response = json.dumps([type_.name, media or body])
+    try:
+        if _respond is None:
+            _respond = get_redis().register_script(RESPOND_SCRIPT)
+        result = _respond(keys=[_phone_key(phone), DIRTY_KEY], args=[phone, response])
+    except redis.RedisError:
+        logger.exception(f"could not record a response from {phone}")
+        return MISS
+    outcome = result[0]
+    if outcome == MISS:
+        return MISS
+    game_id, round_number, players = result[1], int(result[2]), int(result[3])
+    tracing.tag(game_id=game_id)
+    if outcome == IGNORED:
+        return IGNORED
+    if outcome == RECORDED:
+        status_cache.record_response(game_id, round_number, phone)
+        return RECORDED
+    if round_number + 1 < players:
+        # this text's trace follows the next round's prompts out
+        tracing.tag(transition=round_number + 1)
+    tasks.flush_hot_game.apply_async(args=[game_id], queue=tasks.ROUNDS_QUEUE)
+    return RECORDED
+
+
+def responded(game_id, round_number):
+    """Ids of players with a response recorded in a round, flushed or not."""
+    if not ENABLED:
+        return set()
+    try:
+        return {int(p) for p in get_redis().hkeys(_round_key(game_id, round_number))}
+    except redis.RedisError:
+        logger.exception(f"could not read hot state for game {game_id}")
+        return set()
+
+
+def _snapshot(game_id, round_number):
+    pipe = get_redis().pipeline()
+    pipe.hget(_game_key(game_id), "version")
+    pipe.hgetall(_round_key(game_id, round_number))
+    version, responses = pipe.execute()
+    return version or "0", {
+        int(player): json.loads(response) for player, response in responses.items()
+    }
+
+
+def flush(game_id):
+    """
+    Write a game's unwritten responses to its rounds rows, ending the round if
+    they complete it.
+
+    Returns (game, round_over, draws) where draws are (round id, url) pairs to
+    mirror, or None if the game is no longer in progress. The caller enqueues
+    whatever comes next.
+    """
+    # the game's row lock serializes flushes of one game, so only one of them
+    # ends the round
+    game = (
+        model.Game.query.filter_by(id=game_id)
+        .with_for_update()
+        .populate_existing()
+        .one_or_none()
+    )
+    if game is None or game.status != model.Status.IN_PROGRESS:
+        db.session.rollback()
+        evict(game_id)
+        return None
+    round_number = game.current_round
+    try:
+        version, responses = _snapshot(game_id, round_number)
+    except:
+        db.session.rollback()
+        raise
+    rows = (
+        db.session.query(model.GameRound.id, model.GameRound.player)
+        .filter_by(game_id=game_id, round_number=round_number)
+        .filter(model.GameRound.data.is_(None))
+        .all()
+    )
+    pending = {player: id_ for id_, player in rows}
+    writes = [
+        {
+            "round_id": pending[player],
+            "turn_type": model.TurnType[type_],
+            "data": data,
+        }
+        for player, (type_, data) in responses.items()
+        if player in pending
+    ]
+    if writes:
+        rounds = model.GameRound.__table__
+        db.session.execute(
+            rounds.update()
+            .where(rounds.c.id == bindparam("round_id"))
+            .where(rounds.c.data.is_(None))
+            .values(turn_type=bindparam("turn_type"), data=bindparam("data")),
+            writes,
+        )
+        game.touch()
+    round_over = False
+    if game.round_responses or rows:
+        # nothing to count until the round's rows have been created
+        game.round_responses = len(game.players) - len(pending) + len(writes)
+        round_over = game.current_round_is_over
+    if round_over:
+        game.end_round()
+    db.session.commit()
+
+    try:
+        _mark_flushed(game_id, version)
+        if round_over:
+            # the script has usually done this already, but not if the last
+            # response went through the database
+            pipe = get_redis().pipeline()
+            pipe.hset(
+                _game_key(game_id),
+                mapping={"current_round": round_number + 1, "open": "0"},
+            )
+            pipe.delete(_round_key(game_id, round_number))
+            pipe.execute()
+    except redis.RedisError:
+        logger.exception(f"could not update hot state for game {game_id}")
+    draws = [
+        (w["round_id"], w["data"])
+        for w in writes
+        if w["turn_type"] == model.TurnType.DRAW
+    ]
+    return game, round_over, draws
+
+
+def _mark_flushed(game_id, version):
+    global _mark_clean
+    if _mark_clean is None:
+        _mark_clean = get_redis().register_script(MARK_CLEAN_SCRIPT)
+    _mark_clean(keys=[_game_key(game_id), DIRTY_KEY], args=[version, game_id])
+
+
+def dirty_games():
+    return get_redis().smembers(DIRTY_KEY)
@@ -0,0 +1,60 @@
+"""
+Deduplication of inbound webhooks.
+
+Twilio retries /sms when a response is slow, with the same MessageSid. The
+first request for a MessageSid claims it in Redis and stores its TwiML reply
+once handled; a retry gets that stored reply back without the text being
+applied a second time. Claims expire after INBOUND_DEDUPE_TTL, well past
+Twilio's retry window.
+"""
+
+import logging
+import os
+
+import redis
+
+from store import get_redis
+
+logger = logging.getLogger(__name__)
+
+INBOUND_DEDUPE_TTL = int(os.environ.get("INBOUND_DEDUPE_TTL", 24 * 60 * 60))
+
+# stored while the first request is still being handled
+PENDING = ""
+
+
+def _key(sid):
+    return f"inbound:{sid}"
+
+
+def claim(sid):
+    """
+    Claim a MessageSid for handling.
+
+    Returns None if this request should handle the text, or else the reply
+    already stored for it (PENDING if the first request hasn't finished). If
+    Redis is unavailable the text is handled rather than dropped.
+    """
+    try:
+        client = get_redis()
+        if client.set(_key(sid), PENDING, nx=True, ex=INBOUND_DEDUPE_TTL):
+            return None
+        return client.get(_key(sid)) or PENDING
+    except redis.RedisError:
+        logger.exception(f"could not check for a duplicate of {sid}")
+        return None
+
+
+def remember(sid, reply):
+    try:
+        get_redis().set(_key(sid), reply, ex=INBOUND_DEDUPE_TTL)
+    except redis.RedisError:
+        logger.exception(f"could not store the reply to {sid}")
+
+
+def release(sid):
+    """Forget a claim whose handling failed, so a retry can try again."""
+    try:
+        get_redis().delete(_key(sid))
+    except redis.RedisError:
+        logger.exception(f"could not release {sid}")
@@ -0,0 +1,428 @@
+"""
+Load generator and benchmark harness for the SMS game flow.
+
+Drives the real Flask app through /sms for a number of simulated games
+(create -> join -> start -> responses), with Celery tasks run eagerly and a
+fake Twilio client, then reports throughput, p50/p99 latency per command and
+SQL queries per request.
+
+    python loadgen.py --games 100 --players 6 --concurrency 8
+    python loadgen.py --games 20 --record traffic.jsonl
+    python loadgen.py --replay traffic.jsonl
+    python loadgen.py --history 20000 --games 50
+    python loadgen.py --history 20000 --games 50 --archive
+    python loadgen.py --games 20 --concurrency 20 --senders 4 --sender-rate 10
+    python loadgen.py --database sqlite:////tmp/lg.db --replica sqlite:////tmp/lg.db
+    python loadgen.py --games 20 --retries 2
+    python loadgen.py --games 50 --concurrency 8 --hot-state
+
+Round transitions are read back from the traces (see tracing.py) and broken
+down by stage, from the final response to the last prompt sent.
+
+Recorded traffic is one JSON object per line, in the same layout as
+requests.jsonl. --archive compacts the seeded history out of the hot tables
+first, to compare against the same run without it. --replica adds a read
+replica bind and reports how many of each command's queries it served;
+pointing it at the primary's SQLite file stands in for a replica with no lag.
+--retries re-posts every text with the same MessageSid, as Twilio does when a
+webhook is slow; outbound message counts and table sizes should match a run
+without it. --hot-state records responses in Redis and writes them to the
+rounds table at round end (see hot_state.py), so only the response that ends
+each round should run queries, for its eagerly run flush.
+Redis must be reachable at REDIS_URL, and DATABASE_PATH (or --database)
+should point at a scratch database.
+"""
+
+import argparse
+import datetime as dt
+import io
+import itertools
+import json
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+os.environ.setdefault("TWILIO_NUMBER", "+15005550006")
+
+COMMANDS = ["CREATE", "JOIN", "START", "STATUS", "REPEAT PROMPT", "LEAVE"]
+JOIN_LINK = re.compile(r"/join/(\w{4})")
+
+
+class FakeMessage:
+    def __init__(self, sid):
+        self.sid = sid
+
+
+class FakeMessages:
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.sent = 0
+        self.last_sent = {}
+        self.sent_from = defaultdict(int)
+        self._sids = itertools.count()
+        self._lock = threading.Lock()
+
+    def create(self, body=None, from_=None, to=None, media_url=None, **kwargs):
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self.sent += 1
+            self.last_sent[to] = body
+            self.sent_from[from_] += 1
+            return FakeMessage(f"SM{next(self._sids):032x}")
+
+
+class FakeTwilioClient:
+    """Stands in for twilio.rest.Client, optionally with per-call latency."""
+
+    def __init__(self, latency=0):
+        self.messages = FakeMessages(latency)
+
+
+def fake_image():
+    from PIL import Image
+
+    out = io.BytesIO()
+    Image.new("RGB", (64, 48), "white").save(out, "PNG")
+    return out.getvalue()
+
+
+def command_for(body, media):
+    if media:
+        return "RESPONSE (media)"
+    for command in COMMANDS:
+        if body.lower().startswith(command.lower()):
+            return command
+    return "RESPONSE (text)"
+
+
+def percentile(values, pct):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+class Harness:
+    def __init__(
+        self, app, engine, outbox, record=None, replica_engine=None, retries=0
+    ):
+        self.app = app
+        self.retries = retries
+        self.mismatched_retries = 0
+        self.outbox = outbox
+        self.latencies = defaultdict(list)
+        self.queries = defaultdict(list)
+        self.replica_queries = defaultdict(list)
+        self.games = {}
+        self.record = record
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+        from sqlalchemy import event
+
+        event.listen(engine, "before_cursor_execute", self._count_query)
+        if replica_engine is not None:
+            event.listen(replica_engine, "before_cursor_execute", self._count_replica)
+
+    def _count_query(self, *args, **kwargs):
+        self._local.queries = getattr(self._local, "queries", 0) + 1
+
+    def _count_replica(self, *args, **kwargs):
+        self._count_query()
+        self._local.replica_queries = getattr(self._local, "replica_queries", 0) + 1
+
+    def post(self, sim, phone, body, media=None):
+        command = command_for(body, media)
+        if command == "JOIN" and sim in self.games:
+            body = f"join {self.games[sim]}"
+        data = {"From": f"+1{phone}", "Body": body}
+        if media:
+            data["MediaUrl0"] = media
+
+        # a new sid every run, so replayed traffic isn't taken for retries
+        sid = f"SM{uuid.uuid4().hex}"
+        reply = self._send(command, {**data, "MessageSid": sid})
+        for _ in range(self.retries):
+            # Twilio retrying a slow webhook; must change nothing
+            if self._send("RETRY", {**data, "MessageSid": sid}) != reply:
+                self.mismatched_retries += 1
+
+        with self._lock:
+            if command == "CREATE":
+                # with SMS_ASYNC the reply is texted rather than returned
+                reply = reply + (self.outbox.last_sent.get(phone) or "")
+                match = JOIN_LINK.search(reply)
+                if match:
+                    self.games[sim] = match.group(1)
+            if self.record:
+                self.record.write(json.dumps({"game": sim, **data}) + "\n")
+        return reply
+
+    def _send(self, command, data):
+        client = getattr(self._local, "client", None)
+        if client is None:
+            client = self._local.client = self.app.test_client()
+        self._local.queries = 0
+        self._local.replica_queries = 0
+        start = time.perf_counter()
+        reply = client.post("/sms", data=data).get_data(as_text=True)
+        elapsed = time.perf_counter() - start
+
+        with self._lock:
+            self.latencies[command].append(elapsed)
+            self.queries[command].append(self._local.queries)
+            self.replica_queries[command].append(self._local.replica_queries)
+        return reply
+
+
+def simulate_game(harness, sim, num_players, leave=False):
+    phones = [f"555{sim:04d}{i:03d}" for i in range(num_players)]
+    host = phones[0]
+    harness.post(sim, host, "create")
+    for phone in phones[1:]:
+        harness.post(sim, phone, "join")
+    harness.post(sim, phones[-1], "status")
+    harness.post(sim, host, "start")
+    for round_number in range(num_players):
+        if leave and round_number == num_players // 2:
+            harness.post(sim, phones[-1], "leave")
+            return
+        harness.post(sim, host, "repeat prompt")
+        for i, phone in enumerate(phones):
+            if round_number % 2:
+                harness.post(sim, phone, "", f"https://example.com/{sim}/{i}.png")
+            else:
+                harness.post(sim, phone, f"phrase {sim} {round_number} {i}")
+            if i == 0:
+                harness.post(sim, phone, "status")
+
+
+def replay(harness, path):
+    with open(path) as f:
+        for line in f:
+            line = json.loads(line)
+            phone = line["From"][len("+1") :]
+            harness.post(line["game"], phone, line["Body"], line.get("MediaUrl0"))
+
+
+def seed_history(db, model, num_games, num_players):
+    """Insert finished games so the hot tables look like a long-running deploy."""
+    created_at = dt.datetime.utcnow() - dt.timedelta(days=1)
+    for start in range(0, num_games, 500):
+        games = [
+            model.Game.make(status=model.Status.COMPLETED, created_at=created_at)
+            for _ in range(min(500, num_games - start))
+        ]
+        db.session.add_all(games)
+        db.session.flush()
+        for n, game in enumerate(games):
+            players = [
+                model.GamePlayer(
+                    phone=f"999{start + n:04d}{i:03d}"[-10:],
+                    game_id=game.id,
+                    is_host=i == 0,
+                )
+                for i in range(num_players)
+            ]
+            db.session.add_all(players)
+            db.session.flush()
+            ids = [p.id for p in players]
+            game.play_order = [ids[i:] + ids[:i] for i in range(num_players)]
+            game.turn_index = model.TurnRouting.build_index(game.play_order)
+            game.current_round = num_players
+            db.session.add_all(
+                model.GameRound(
+                    game_id=game.id,
+                    player=p.id,
+                    round_number=r,
+                    data=f"history {r}",
+                )
+                for r in range(num_players)
+                for p in players
+            )
+        db.session.commit()
+        print(f"seeded {start + len(games)} historical games", file=sys.stderr)
+
+
+def table_sizes(model):
+    return {
+        table.__tablename__: table.query.count()
+        for table in (model.Game, model.GamePlayer, model.GameRound, model.GameArchive)
+    }
+
+
+class RecordingSleep:
+    """Sleeps like time.sleep, keeping each rate-limit wait for the report."""
+
+    def __init__(self):
+        self.waits = []
+
+    def __call__(self, seconds):
+        self.waits.append(seconds)
+        time.sleep(seconds)
+
+
+def report(harness, elapsed, outbox, waits, sizes, transitions):
+    total = sum(len(v) for v in harness.latencies.values())
+    print(f"{total} requests in {elapsed:.2f}s ({total / elapsed:.1f} req/s)")
+    print(
+        f"{outbox.sent} outbound messages from {len(outbox.sent_from)} senders, "
+        f"busiest sent {max(outbox.sent_from.values(), default=0)}; "
+        f"{len(waits)} waited on a rate limit, "
+        f"p50 {percentile(waits, 50) * 1000:.1f} ms, p99 {percentile(waits, 99) * 1000:.1f} ms"
+    )
+    print(
+        f"{'command':<18}{'count':>8}{'p50 ms':>10}{'p99 ms':>10}{'queries':>10}"
+        f"{'replica':>10}"
+    )
+    for command in sorted(harness.latencies):
+        latencies = harness.latencies[command]
+        queries = harness.queries[command]
+        replica_queries = harness.replica_queries[command]
+        print(
+            f"{command:<18}{len(latencies):>8}"
+            f"{percentile(latencies, 50) * 1000:>10.1f}"
+            f"{percentile(latencies, 99) * 1000:>10.1f}"
+            f"{sum(queries) / len(queries):>10.1f}"
+            f"{sum(replica_queries) / len(replica_queries):>10.1f}"
+        )
+    print("rows: " + ", ".join(f"{table} {count}" for table, count in sizes.items()))
+    if transitions:
+        print(f"{len(transitions)} round transitions")
+        print(f"{'stage':<18}{'p50 ms':>10}{'p99 ms':>10}")
+        for stage in ["total"] + sorted({s for t in transitions for s in t["stages"]}):
+            seconds = [
+                t["total_seconds"] if stage == "total" else t["stages"].get(stage, 0)
+                for t in transitions
+            ]
+            print(
+                f"{stage:<18}"
+                f"{percentile(seconds, 50) * 1000:>10.1f}"
+                f"{percentile(seconds, 99) * 1000:>10.1f}"
+            )
+    if harness.retries:
+        print(f"{harness.mismatched_retries} retries got a different reply")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--games", type=int, default=10)
+    parser.add_argument("--players", type=int, default=4)
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument(
+        "--leave-every", type=int, default=0, help="abandon every Nth game midway"
+    )
+    parser.add_argument("--twilio-latency", type=float, default=0, help="seconds")
+    parser.add_argument("--senders", type=int, default=1, help="sender numbers")
+    parser.add_argument(
+        "--sender-rate",
+        type=float,
+        default=0,
+        help="messages per second per sender; 0 for no limit",
+    )
+    parser.add_argument("--history", type=int, default=0)
+    parser.add_argument(
+        "--archive", action="store_true", help="archive finished games before the run"
+    )
+    parser.add_argument("--database", help="overrides DATABASE_PATH")
+    parser.add_argument("--replica", help="read replica database URL")
+    parser.add_argument(
+        "--retries", type=int, default=0, help="re-post every text N more times"
+    )
+    parser.add_argument(
+        "--hot-state", action="store_true", help="keep games in progress in Redis"
+    )
+    parser.add_argument("--record")
+    parser.add_argument("--replay")
+    args = parser.parse_args()
+
+    if args.database:
+        os.environ["DATABASE_PATH"] = args.database
+    if args.replica:
+        os.environ["DATABASE_REPLICA_PATH"] = args.replica
+    if args.hot_state:
+        os.environ["HOT_STATE"] = "true"
+
+    import archive
+    import media
+    import model
+    import outbound
+    import server
+    import tasks
+    import tracing
+    import twilio_conf
+
+    tasks.celery_app.conf.task_always_eager = True
+    twilio_conf.client = FakeTwilioClient(args.twilio_latency)
+    sleep = RecordingSleep()
+    outbound.scheduler = outbound.OutboundScheduler(
+        [f"+1500555{i:04d}" for i in range(args.senders)],
+        args.sender_rate,
+        sleep=sleep,
+    )
+    # drawings are "fetched" from memory into a scratch media store
+    image = fake_image()
+    media.fetch = lambda url: (image, "image/png")
+    media.MEDIA_ROOT = tempfile.mkdtemp(prefix="loadgen-media-")
+
+    # the fake traffic isn't signed
+    app = server.create_app({"TWILIO_VALIDATE_SIGNATURES": False})
+    with app.app_context():
+        server.db.create_all()
+        if args.history:
+            seed_history(server.db, model, args.history, args.players)
+        if args.archive:
+            print(f"archived {archive.backfill(0)} games", file=sys.stderr)
+
+    record = open(args.record, "w") if args.record else None
+    with app.app_context():
+        engine = server.db.engine
+        replica_engine = None
+        if args.replica:
+            replica_engine = server.db.get_engine(bind=server.REPLICA_BIND)
+    harness = Harness(
+        app,
+        engine,
+        twilio_conf.client.messages,
+        record,
+        replica_engine,
+        args.retries,
+    )
+
+    # no app context around the requests, so each one gets its own database
+    # session as it would in production
+    def run_game(sim):
+        leave = bool(args.leave_every) and sim % args.leave_every == 0
+        simulate_game(harness, sim, args.players, leave)
+
+    start = time.perf_counter()
+    if args.replay:
+        replay(harness, args.replay)
+    else:
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            list(pool.map(run_game, range(args.games)))
+    elapsed = time.perf_counter() - start
+
+    if record:
+        record.close()
+    with app.app_context():
+        sizes = table_sizes(model)
+    transitions = [
+        trace
+        for game_id in set(harness.games.values())
+        for trace in tracing.game_traces(game_id, transitions_only=True)
+    ]
+    report(
+        harness, elapsed, twilio_conf.client.messages, sleep.waits, sizes, transitions
+    )
+
+
+if __name__ == "__main__":
+    main()
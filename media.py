@@ -0,0 +1,114 @@
+"""
+Local, content-addressed copies of drawings.
+
+Each drawing is fetched once from its Twilio media URL and saved under its
+SHA-256 digest, along with a small JPEG thumbnail for the gallery. Files never
+change once written, so they can be served with long-lived cache headers.
+
+Only Twilio's own media URLs are fetched, since MediaUrl0 comes from the
+inbound webhook and the account credentials may be sent along with it.
+"""
+import hashlib
+import io
+import mimetypes
+import os
+import re
+from urllib.parse import urlsplit
+
+import requests
+from dotenv import load_dotenv
+
+load_dotenv()
+
+MEDIA_ROOT = os.environ.get(
+    "MEDIA_ROOT", os.path.join(os.path.dirname(os.path.abspath(__file__)), "media")
+)
+MAX_MEDIA_BYTES = int(os.environ.get("MAX_MEDIA_BYTES", 5 * 1024 * 1024))
+THUMBNAIL_SIZE = (400, 400)
+FETCH_TIMEOUT = 10
+# Twilio redirects from here to its CDN; requests drops the credentials when
+# it follows a redirect to another host.
+TWILIO_MEDIA_HOST = "api.twilio.com"
+
+# <sha256 digest>.<ext> for originals, <sha256 digest>.thumb.jpg for thumbnails
+MEDIA_NAME = re.compile(r"^[0-9a-f]{64}(\.thumb)?\.[a-z0-9]+$")
+
+
+class MediaTooLarge(Exception):
+    pass
+
+
+class UntrustedMediaUrl(Exception):
+    pass
+
+
+def path_for(name):
+    return os.path.join(MEDIA_ROOT, name[:2], name)
+
+
+def thumbnail_name(name):
+    return name.split(".", 1)[0] + ".thumb.jpg"
+
+
+def is_twilio_media(url):
+    parts = urlsplit(url)
+    return (
+        parts.scheme == "https"
+        and parts.hostname == TWILIO_MEDIA_HOST
+        and parts.port in (None, 443)
+    )
+
+
+def fetch(url):
+    """Download media from Twilio, returning its bytes and content type."""
+    if not is_twilio_media(url):
+        raise UntrustedMediaUrl(f"{url} is not a Twilio media URL")
+    auth = None
+    if os.environ.get("TWILIO_MEDIA_AUTH", "").lower() == "true":
+        auth = (os.environ["TWILIO_ACCOUNT_SID"], os.environ["TWILIO_AUTH_TOKEN"])
+    with requests.get(url, auth=auth, timeout=FETCH_TIMEOUT, stream=True) as response:
+        response.raise_for_status()
+        content = io.BytesIO()
+        for chunk in response.iter_content(64 * 1024):
+            content.write(chunk)
+            if content.tell() > MAX_MEDIA_BYTES:
+                raise MediaTooLarge(f"{url} is larger than {MAX_MEDIA_BYTES} bytes")
+        content_type = response.headers.get("Content-Type", "application/octet-stream")
+    return content.getvalue(), content_type.split(";")[0].strip()
+
+
+def _write(name, content):
+    path = path_for(name)
+    if os.path.exists(path):
+        return
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # write then rename so a reader never sees a partial file
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+
+def make_thumbnail(content):
+    from PIL import Image
+
+    image = Image.open(io.BytesIO(content))
+    image.thumbnail(THUMBNAIL_SIZE)
+    out = io.BytesIO()
+    image.convert("RGB").save(out, "JPEG", quality=80, optimize=True)
+    return out.getvalue()
+
+
+def save(content, content_type):
+    """Store media and its thumbnail, returning the original's file name."""
+    extension = (mimetypes.guess_extension(content_type) or ".bin").lstrip(".")
+    name = f"{hashlib.sha256(content).hexdigest()}.{extension}"
+    # raises before anything is written if the content isn't an image
+    thumbnail = make_thumbnail(content)
+    _write(name, content)
+    _write(thumbnail_name(name), thumbnail)
+    return name
+
+
+def mirror(url):
+    return save(*fetch(url))
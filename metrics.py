@@ -0,0 +1,279 @@
+"""
+Request, SQL, Celery task and Twilio instrumentation.
+
+Observations are buffered in-process and flushed to Redis once per request or
+task, so web and worker processes add to the same histograms. GET /metrics
+renders them in the Prometheus text format; nginx only serves it to the host
+itself.
+
+Inbound texts are also traced through the tasks they set off; see tracing.py.
+
+Requests slower than SLOW_REQUEST_SECONDS are logged along with their slowest
+queries, and PROFILE_SAMPLE_RATE (0 to 1) turns on cProfile for that fraction
+of requests, logging the top functions by cumulative time.
+"""
+import cProfile
+import io
+import logging
+import os
+import pstats
+import random
+import threading
+import time
+
+import redis
+from celery.signals import before_task_publish, task_postrun, task_prerun
+from flask import g, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+import tracing
+from store import get_redis
+
+logger = logging.getLogger(__name__)
+
+SLOW_REQUEST_SECONDS = float(os.environ.get("SLOW_REQUEST_SECONDS", 1))
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", 0))
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+COUNT_BUCKETS = (1, 2, 3, 5, 10, 20, 50, 100)
+
+HISTOGRAMS = {
+    "http_request_seconds": ("Latency of HTTP requests.", LATENCY_BUCKETS),
+    "sql_queries_per_request": ("SQL queries run per request.", COUNT_BUCKETS),
+    "sql_seconds_per_request": ("Time spent in SQL per request.", LATENCY_BUCKETS),
+    "celery_queue_wait_seconds": (
+        "Time from publishing a task to a worker starting it.",
+        LATENCY_BUCKETS,
+    ),
+    "celery_task_seconds": ("Run time of Celery tasks.", LATENCY_BUCKETS),
+    "sql_queries_per_task": ("SQL queries run per Celery task.", COUNT_BUCKETS),
+    "twilio_request_seconds": ("Latency of Twilio API calls.", LATENCY_BUCKETS),
+    "round_transition_seconds": (
+        "Time from a round's last response to the next round's prompts going out.",
+        LATENCY_BUCKETS,
+    ),
+    "sms_send_wait_seconds": (
+        "Time an outbound text waited on its sender's rate limit.",
+        (0,) + LATENCY_BUCKETS,
+    ),
+}
+
+KEY_PREFIX = "metrics:"
+
+# Commands recognized as the first word of an inbound text; anything else is a
+# game response. Keeps the command label's cardinality fixed.
+SMS_COMMANDS = {"create", "join", "start", "status", "leave", "repeat", "resend"}
+
+_pending = []
+_pending_lock = threading.Lock()
+_local = threading.local()
+
+
+def observe(name, value, **labels):
+    label_str = ",".join(f'{k}="{v}"' for k, v in sorted(labels.items()))
+    with _pending_lock:
+        _pending.append((name, label_str, value))
+
+
+class timed:
+    """Context manager observing the duration of its block."""
+
+    def __init__(self, name, **labels):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        observe(self.name, time.perf_counter() - self.start, **self.labels)
+
+
+def flush():
+    global _pending
+    with _pending_lock:
+        pending, _pending = _pending, []
+    if not pending:
+        return
+    try:
+        pipe = get_redis().pipeline(transaction=False)
+        for name, labels, value in pending:
+            key = KEY_PREFIX + name
+            for bucket in HISTOGRAMS[name][1]:
+                if value <= bucket:
+                    pipe.hincrby(key, f"{labels}|{bucket}", 1)
+            pipe.hincrby(key, f"{labels}|+Inf", 1)
+            pipe.hincrbyfloat(key, f"{labels}|sum", value)
+        pipe.execute()
+    except redis.RedisError:
+        logger.exception("could not flush metrics")
+
+
+def render():
+    redis_client = get_redis()
+    lines = []
+    for name, (help_, buckets) in HISTOGRAMS.items():
+        values = redis_client.hgetall(KEY_PREFIX + name)
+        if not values:
+            continue
+        lines.append(f"# HELP {name} {help_}")
+        lines.append(f"# TYPE {name} histogram")
+        label_sets = sorted({field.rsplit("|", 1)[0] for field in values})
+        for labels in label_sets:
+            sep = "," if labels else ""
+            for bucket in list(buckets) + ["+Inf"]:
+                count = values.get(f"{labels}|{bucket}", 0)
+                lines.append(f'{name}_bucket{{{labels}{sep}le="{bucket}"}} {count}')
+            series = f"{{{labels}}}" if labels else ""
+            lines.append(f"{name}_sum{series} {values.get(f'{labels}|sum', 0)}")
+            lines.append(f"{name}_count{series} {values.get(f'{labels}|+Inf', 0)}")
+    return "\n".join(lines) + "\n"
+
+
+# SQL: queries are collected for whichever request or task is running on this
+# thread. Eager Celery tasks run inside a request, so collectors nest.
+
+
+def _collectors():
+    if not hasattr(_local, "collectors"):
+        _local.collectors = []
+    return _local.collectors
+
+
+def _stop_collecting(queries):
+    collectors = _collectors()
+    for i, collector in enumerate(collectors):
+        if collector is queries:
+            del collectors[i]
+            return
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    context._metrics_start = time.perf_counter()
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - context._metrics_start
+    for queries in _collectors():
+        queries.append((elapsed, statement))
+
+
+def _sms_command():
+    words = (request.form.get("Body") or "").strip().lower().split()
+    if words and words[0] in SMS_COMMANDS:
+        return words[0]
+    return "response"
+
+
+def _before_request():
+    g.metrics_start = time.perf_counter()
+    g.metrics_wall_start = time.time()
+    g.trace_token = None
+    if request.endpoint == "game.receive_sms":
+        g.trace_token = tracing.start(request.headers.get("X-Trace-Id"))
+    g.queries = []
+    _collectors().append(g.queries)
+    g.profiler = None
+    if PROFILE_SAMPLE_RATE and random.random() < PROFILE_SAMPLE_RATE:
+        g.profiler = cProfile.Profile()
+        g.profiler.enable()
+
+
+def _teardown_request(exc):
+    if "metrics_start" not in g:
+        return
+    elapsed = time.perf_counter() - g.metrics_start
+    _stop_collecting(g.queries)
+    labels = {"endpoint": request.endpoint or "unknown"}
+    if request.endpoint == "game.receive_sms":
+        labels["command"] = _sms_command()
+
+    sql_seconds = sum(t for t, _ in g.queries)
+    observe("http_request_seconds", elapsed, **labels)
+    observe("sql_queries_per_request", len(g.queries), **labels)
+    observe("sql_seconds_per_request", sql_seconds, **labels)
+    if g.trace_token:
+        tracing.record("webhook", g.metrics_wall_start, elapsed, **labels)
+        tracing.record("db", g.metrics_wall_start, sql_seconds, queries=len(g.queries))
+
+    if elapsed > SLOW_REQUEST_SECONDS:
+        slowest = sorted(g.queries, reverse=True)[:3]
+        logger.warning(
+            f"slow request {labels} took {elapsed:.3f}s with {len(g.queries)} queries; "
+            + "; ".join(f"{t:.3f}s: {statement}" for t, statement in slowest)
+        )
+    if g.profiler:
+        g.profiler.disable()
+        out = io.StringIO()
+        pstats.Stats(g.profiler, stream=out).sort_stats("cumulative").print_stats(20)
+        logger.info(f"profile for {labels}:\n{out.getvalue()}")
+    flush()
+    if g.trace_token:
+        tracing.flush()
+        tracing.end(g.trace_token)
+
+
+def init_app(app):
+    app.before_request(_before_request)
+    app.teardown_request(_teardown_request)
+
+    @app.route("/metrics")
+    def show_metrics():
+        return render(), 200, {"Content-Type": "text/plain; version=0.0.4"}
+
+    tracing.init_app(app)
+
+
+# Celery
+
+
+@before_task_publish.connect
+def _record_publish_time(headers=None, **kwargs):
+    if headers is not None:
+        headers["published_at"] = time.time()
+        if tracing.current():
+            headers["trace"] = tracing.current()
+
+
+@task_prerun.connect
+def _task_started(task=None, **kwargs):
+    # eager tasks have no headers and stay in the caller's trace
+    trace = getattr(task.request, "trace", None)
+    task.request.trace_token = tracing.resume(trace) if trace else None
+    published_at = getattr(task.request, "published_at", None)
+    if published_at:
+        wait = time.time() - published_at
+        observe("celery_queue_wait_seconds", wait, task=task.name)
+        tracing.record("queue_wait", published_at, wait, task=task.name)
+    task.request.metrics_start = time.perf_counter()
+    task.request.metrics_wall_start = time.time()
+    task.request.queries = []
+    _collectors().append(task.request.queries)
+
+
+@task_postrun.connect
+def _task_finished(task=None, **kwargs):
+    start = getattr(task.request, "metrics_start", None)
+    if start is None:
+        return
+    _stop_collecting(task.request.queries)
+    elapsed = time.perf_counter() - start
+    observe("celery_task_seconds", elapsed, task=task.name)
+    observe("sql_queries_per_task", len(task.request.queries), task=task.name)
+    flush()
+    wall_start = task.request.metrics_wall_start
+    tracing.record("task", wall_start, elapsed, task=task.name)
+    tracing.record(
+        "db",
+        wall_start,
+        sum(t for t, _ in task.request.queries),
+        queries=len(task.request.queries),
+        task=task.name,
+    )
+    tracing.flush()
+    if task.request.trace_token:
+        tracing.end(task.request.trace_token)
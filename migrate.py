@@ -0,0 +1,173 @@
+"""
+Bring an existing database up to date with model.py.
+
+db.create_all() creates missing tables but won't touch tables that already
+exist, so new columns and indexes are applied here.
+
+    python migrate.py            # add missing columns and indexes
+    python migrate.py --explain  # print query plans for the hot queries
+"""
+import logging
+import sys
+
+from sqlalchemy import inspect, text
+
+import model
+from server import create_app, db
+
+logger = logging.getLogger(__name__)
+
+# (table, column, column DDL, backfill statement run once after adding it)
+COLUMNS = [
+    (
+        "games",
+        "round_responses",
+        "INTEGER NOT NULL DEFAULT 0",
+        """
+        UPDATE games SET round_responses = (
+            SELECT COUNT(*) FROM rounds
+            WHERE rounds.game_id = games.id
+            AND rounds.round_number = games.current_round
+            AND rounds.data IS NOT NULL
+        )
+        """,
+    ),
+    ("rounds", "media_file", "VARCHAR(80)", None),
+    (
+        "games",
+        "last_activity_at",
+        "TIMESTAMP",
+        "UPDATE games SET last_activity_at = created_at",
+    ),
+    # games from before the sender pool fall back to TWILIO_NUMBER
+    ("games", "sender", "VARCHAR(20)", None),
+    ("rounds", "prompt_status", "VARCHAR(16)", None),
+    ("rounds", "prompt_attempts", "INTEGER NOT NULL DEFAULT 1", None),
+    # games started without it build it from play_order when needed
+    ("games", "turn_index", "JSON", None),
+    # existing games are left out of id counter reseeds
+    ("games", "id_index", "INTEGER", None),
+]
+
+
+def add_missing_columns():
+    inspector = inspect(db.engine)
+    for table, column, ddl, backfill in COLUMNS:
+        existing = {c["name"] for c in inspector.get_columns(table)}
+        if column in existing:
+            continue
+        logger.info(f"adding column {table}.{column}")
+        db.session.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}"))
+        if backfill:
+            db.session.execute(text(backfill))
+        db.session.commit()
+
+
+# (table, constraint name, columns, index it replaces, statement that removes
+# rows the constraint would reject)
+UNIQUE_CONSTRAINTS = [
+    (
+        "rounds",
+        "uq_rounds_game_round_player",
+        ["game_id", "round_number", "player"],
+        "ix_rounds_game_round_player",
+        # keep the row with a response, or else the first one
+        """
+        DELETE FROM rounds WHERE data IS NULL AND EXISTS (
+            SELECT 1 FROM rounds AS other
+            WHERE other.game_id = rounds.game_id
+            AND other.round_number = rounds.round_number
+            AND other.player = rounds.player
+            AND (other.data IS NOT NULL OR other.id < rounds.id)
+        )
+        """,
+    ),
+]
+
+
+def add_missing_unique_constraints():
+    inspector = inspect(db.engine)
+    for table, name, columns, replaces, dedupe in UNIQUE_CONSTRAINTS:
+        existing = {c["name"] for c in inspector.get_unique_constraints(table)}
+        existing |= {i["name"] for i in inspector.get_indexes(table)}
+        if name in existing:
+            continue
+        logger.info(f"adding unique constraint {table}.{name}")
+        db.session.execute(text(dedupe))
+        # a unique index enforces the same thing and can be added in SQLite too
+        db.session.execute(
+            text(f"CREATE UNIQUE INDEX {name} ON {table} ({', '.join(columns)})")
+        )
+        db.session.execute(text(f"DROP INDEX IF EXISTS {replaces}"))
+        db.session.commit()
+
+
+# indexes another one now covers: ix_games_status_last_activity leads with status
+REDUNDANT_INDEXES = ["ix_games_status"]
+
+
+def drop_redundant_indexes():
+    for name in REDUNDANT_INDEXES:
+        logger.info(f"dropping index {name} if present")
+        db.session.execute(text(f"DROP INDEX IF EXISTS {name}"))
+    db.session.commit()
+
+
+def create_missing_indexes():
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            logger.info(f"creating index {index.name} if missing")
+            index.create(bind=db.engine, checkfirst=True)
+
+
+def upgrade():
+    db.create_all()
+    add_missing_columns()
+    add_missing_unique_constraints()
+    create_missing_indexes()
+    drop_redundant_indexes()
+
+
+def hot_queries(phone="5550000000", game_id="XXXX"):
+    """The queries every inbound text or round transition runs."""
+    return {
+        "active player context": model.GamePlayer.query.join(model.GamePlayer.game)
+        .filter(
+            model.GamePlayer.phone == phone,
+            model.Game.status.in_(model.ACTIVE_STATUSES),
+        )
+        .statement,
+        "current round rows": model.GameRound.query.filter_by(
+            game_id=game_id, round_number=1
+        ).statement,
+        "pending players": model.GameRound.query.filter(
+            model.GameRound.game_id == game_id,
+            model.GameRound.round_number == 1,
+            model.GameRound.data.is_(None),
+        ).statement,
+        "player round": model.GameRound.query.filter_by(
+            game_id=game_id, round_number=1, player=1
+        ).statement,
+        "stale games": model.Game.query.filter(
+            model.Game.status.in_(model.ACTIVE_STATUSES),
+            model.Game.last_activity_at < "2000-01-01",
+        ).statement,
+    }
+
+
+def explain():
+    prefix = "EXPLAIN QUERY PLAN" if db.engine.name == "sqlite" else "EXPLAIN"
+    for name, statement in hot_queries().items():
+        sql = statement.compile(db.engine, compile_kwargs={"literal_binds": True})
+        print(f"-- {name}")
+        for row in db.session.execute(text(f"{prefix} {sql}")):
+            print("  ", " ".join(str(col) for col in row))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    create_app().app_context().push()
+    if "--explain" in sys.argv:
+        explain()
+    else:
+        upgrade()
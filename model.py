@@ -1,16 +1,23 @@
 import datetime as dt
 import enum
-import itertools
+import json
 import logging
-import os
 import random
-import string
-import sys
+import zlib
 
-import tasks
-from server import db
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import contains_eager
+
+import game_ids
+import outbound
+import status_cache
+import tracing
+from database import db
 from twilio_conf import twilio_num
 
+# tasks and hot_state import this module, so methods that use them import them
+# locally.
+
 logger = logging.getLogger(__name__)
 
 from dotenv import load_dotenv
@@ -31,38 +38,75 @@ class TurnType(enum.Enum):
     WRITE = 2
 
 
+ACTIVE_STATUSES = [Status.CREATED, Status.STARTED, Status.IN_PROGRESS]
+FINISHED_STATUSES = [Status.COMPLETED, Status.ABANDONED]
+
+MAX_ID_ATTEMPTS = 10
+
+
 class Game(db.Model):
     __tablename__ = "games"
+    __table_args__ = (
+        db.Index("ix_games_status_last_activity", "status", "last_activity_at"),
+    )
 
     id = db.Column(db.String(4), primary_key=True)
     status = db.Column(db.Enum(Status))
     created_at = db.Column(db.DateTime)
     play_order = db.Column(db.JSON)
+    # {player id: chain index in each round}, built with play_order; see
+    # TurnRouting
+    turn_index = db.Column(db.JSON)
     current_round = db.Column(db.Integer)
-
-    @staticmethod
-    def generate_id():
-        letters_no_vowels = list(set(string.ascii_letters) - set("aeiouAEIOU"))
-        return "".join(random.choice(letters_no_vowels) for i in range(4))
+    # Responses recorded so far in current_round, kept in step with the rounds
+    # rows under the game's row lock.
+    round_responses = db.Column(db.Integer, default=0, server_default="0")
+    # when a player last joined, started or responded, for reaping stale games
+    last_activity_at = db.Column(db.DateTime)
+    # number the game's texts are sent from, fixed for the whole game
+    sender = db.Column(db.String(20))
+    # counter value the id was allocated from; None for recycled ids and ids
+    # from before the counter, which the counter is never reseeded past
+    id_index = db.Column(db.Integer)
+
+    # Rounds rows for the round currently being played, so status checks can be
+    # answered from an eager load instead of separate COUNT queries.
+    current_rounds = db.relationship(
+        "GameRound",
+        primaryjoin="and_(Game.id == GameRound.game_id, "
+        "Game.current_round == foreign(GameRound.round_number))",
+        viewonly=True,
+    )
 
     @classmethod
     def make(cls, id=None, status=Status.CREATED, created_at=None):
-        id = id or cls.generate_id()
-        while cls.query.get(id):
-            logger.info("generating new game id")
-            id = cls.generate_id()
+        id, id_index = (id, None) if id else game_ids.allocate()
+        created_at = created_at or dt.datetime.utcnow()
         game = cls(
             id=id,
+            id_index=id_index,
             status=status,
-            created_at=created_at or dt.datetime.utcnow(),
+            sender=outbound.get_scheduler().sender_for(id),
+            created_at=created_at,
+            last_activity_at=created_at,
             current_round=0,
+            round_responses=0,
         )
         return game
 
-    def add_player(self, phone):
+    @property
+    def from_number(self):
+        # games from before the sender pool have no sender stored
+        return self.sender or twilio_num
+
+    def touch(self):
+        self.last_activity_at = dt.datetime.utcnow()
+
+    def add_player(self, phone, check_other_games=True):
+        import tasks
+
         is_host = len(self.players) == 0
-        already_playing = GamePlayer.playing_other_game(phone)
-        if already_playing:
+        if check_other_games and GamePlayer.playing_other_game(phone):
             logger.info("player is already playing another game, not adding")
             return
         else:
@@ -74,22 +118,36 @@ class Game(db.Model):
             )
 
             db.session.add(player)
+            self.touch()
+            host = next((p for p in self.players if p.is_host), None)
             db.session.commit()
 
-        if not is_host:
-            host = GamePlayer.query.filter_by(game_id=self.id, is_host=True).one()
-            print("SENDING")
+        if host:
             tasks.send_sms.apply_async(
-                args=[f"{phone} joined game.", None, twilio_num, host.phone, None]
+                args=[f"{phone} joined game.", None, self.from_number, host.phone, None]
             )
         return player
 
+    @classmethod
+    def last_id_index(cls):
+        # only read after a collision, so it goes without an index
+        return db.session.query(db.func.max(cls.id_index)).scalar()
+
     @classmethod
     def create_game(cls, phone):
-        game_id = cls.generate_id()
-        game = cls.make()
-        db.session.add(game)
-        db.session.flush()
+        for attempt in range(MAX_ID_ATTEMPTS):
+            game = cls.make()
+            db.session.add(game)
+            try:
+                db.session.flush()
+                break
+            except IntegrityError:
+                # the counter was lost or rolled back, or the id predates it
+                logger.warning(f"game id {game.id} already taken, reseeding ids")
+                db.session.rollback()
+                game_ids.reseed(cls.last_id_index())
+        else:
+            raise game_ids.GameIdsExhausted("Could not allocate an unused game id.")
         player = game.add_player(phone)
         logger.info("committing game and player.")
         db.session.commit()
@@ -106,97 +164,107 @@ class Game(db.Model):
         sent to C; C will write a word based on B's drawing; D will receive C's word and draw it.
         """
 
-        def rotate(l, times):
-            """
-            Rotate a list right n times.
-            """
-
-            r = itertools.cycle(l)
-            for i in range(times):
-                next(r)
-            return [next(r) for i in l]
-
-        send_order = [rotate(self.players, i) for i in range(len(self.players))]
+        ids = [p.id for p in self.players]
+        send_order = [ids[i:] + ids[:i] for i in range(len(ids))]
         random.shuffle(send_order)
-        return [[p.id for p in turn] for turn in send_order]
+        return send_order
+
+    @property
+    def routing(self):
+        return TurnRouting(self.play_order or [], self.turn_index)
 
     def start_game(self):
+        import tasks
+
         if self.status != Status.CREATED:
             logger.info("game already started, continuing")
             return
         self.play_order = self._generate_turn_order()
+        self.turn_index = TurnRouting.build_index(self.play_order)
         self.status = Status.STARTED
+        self.touch()
         db.session.add(self)
         db.session.commit()
         tasks.start_game.apply_async(args=[self.id])
 
     @property
     def current_round_responses(self):
-        return GameRound.query.filter(
-            GameRound.game_id == self.id,
-            GameRound.round_number == self.current_round,
-            GameRound.data.isnot(None),
-        ).count()
+        return self.round_responses or 0
 
     @property
     def current_round_is_over(self):
-        num_players = len(self.players)
-        return num_players == self.current_round_responses
+        return self.current_round_responses >= len(self.players)
 
     @property
     def game_is_over(self):
-        num_players = len(self.players)
-        final_round = GameRound.query.filter(
-            GameRound.game_id == self.id,
-            GameRound.round_number == num_players - 1,
-            GameRound.data.isnot(None),
-        )
-        return num_players == final_round.count()
+        return self.current_round >= len(self.players)
 
     @property
     def waiting_on_players(self):
-        waiting_player_ids = (
-            db.session.query(GameRound.player)
-            .filter(
-                GameRound.game_id == self.id,
-                GameRound.round_number == self.current_round,
-                GameRound.data == None,
-            )
-            .subquery()
-        )
-        waiting_player_numbers = db.session.query(GamePlayer.phone).filter(
-            GamePlayer.id.in_(waiting_player_ids)
-        )
-        return [p for p, in waiting_player_numbers]
+        waiting_player_ids = {r.player for r in self.current_rounds if r.data is None}
+        return [p.phone for p in self.players if p.id in waiting_player_ids]
 
     def end_round(self):
-        self.current_round += 1
-        db.session.add(self)
-        db.session.commit()
+        """Move on to the next round, completing the game after the last one.
 
+        Must be called while holding the game's row lock; the caller commits.
+        """
+        self.current_round += 1
+        self.round_responses = 0
         if self.game_is_over:
             self.status = Status.COMPLETED
-            db.session.commit()
-            tasks.send_gallery_view.delay(self.id)
-        else:
-            tasks.start_new_round.delay(self.id)
 
-    def add_player_response(self, id_, media, body):
-        # TODO: error handling if we get a phone that's not part of this game session
+    def add_player_response(self, round, media, body):
+        import hot_state
+        import tasks
+
         type_ = TurnType.DRAW if media else TurnType.WRITE
-        round = GameRound.query.filter_by(
-            game_id=self.id, player=id_, round_number=self.current_round
-        ).first()
-        round.data = media if type_ == TurnType.DRAW else body
-        round.type = type_
-        db.session.commit()
+        data = media if type_ == TurnType.DRAW else body
+        round_id = round.id
+        round_number = round.round_number
+        phone = next(p.phone for p in self.players if p.id == round.player)
+        # Only the first response for a round row counts; a repeat is ignored.
+        recorded = GameRound.query.filter(
+            GameRound.id == round.id, GameRound.data.is_(None)
+        ).update({"data": data, "turn_type": type_}, synchronize_session=False)
+        if not recorded:
+            logger.info("response already recorded for this round, ignoring")
+            db.session.rollback()
+            return
 
-        if self.current_round_is_over:
+        # Lock the game row so concurrent responses count one at a time and
+        # exactly one of them sees the round finish.
+        Game.query.filter_by(id=self.id).with_for_update().populate_existing().one()
+        self.round_responses = self.current_round_responses + 1
+        self.touch()
+        round_over = self.current_round_is_over
+        if round_over:
             self.end_round()
+        game_over = self.status == Status.COMPLETED
+        if round_over and not game_over:
+            # this text's trace follows the next round's prompts out
+            tracing.tag(transition=self.current_round)
+        db.session.commit()
+
+        if round_over:
+            status_cache.clear(self.id, round_number)
+        else:
+            status_cache.record_response(self.id, round_number, phone)
+        if type_ == TurnType.DRAW:
+            tasks.mirror_media.delay(round_id, media)
+        if game_over:
+            hot_state.evict(self.id)
+            tasks.send_gallery_view.delay(self.id)
+        elif round_over:
+            tasks.start_new_round.delay(self.id)
 
 
 class GamePlayer(db.Model):
     __tablename__ = "players"
+    __table_args__ = (
+        db.Index("ix_players_phone_game_id", "phone", "game_id"),
+        db.Index("ix_players_game_id", "game_id"),
+    )
 
     # only supports US numbers right now
     id = db.Column(db.Integer, autoincrement=True, primary_key=True)
@@ -214,21 +282,79 @@ class GamePlayer(db.Model):
             GamePlayer.query.join(Game)
             .filter(
                 GamePlayer.phone == phone,
-                Game.status.in_(["CREATED", "STARTED", "IN_PROGRESS"]),
+                Game.status.in_(ACTIVE_STATUSES),
             )
             .count()
             > 0
         )
 
+    @staticmethod
+    def active_game_id(phone):
+        row = (
+            db.session.query(GamePlayer.game_id)
+            .join(Game)
+            .filter(
+                GamePlayer.phone == phone,
+                Game.status.in_(ACTIVE_STATUSES),
+            )
+            .first()
+        )
+        return row[0] if row else None
+
+    @staticmethod
+    def active_context(phone):
+        """
+        Load everything needed to answer an inbound text in one query.
+
+        Returns a PlayerContext for the player's active game, with the game, its
+        roster and the current round's rows eager-loaded, or None if the phone is
+        not playing a game.
+        """
+        players = (
+            GamePlayer.query.join(GamePlayer.game)
+            .options(
+                contains_eager(GamePlayer.game).joinedload(Game.players),
+                contains_eager(GamePlayer.game).joinedload(Game.current_rounds),
+            )
+            .filter(
+                GamePlayer.phone == phone,
+                Game.status.in_(ACTIVE_STATUSES),
+            )
+            .all()
+        )
+        if not players:
+            return None
+        return PlayerContext(players[0])
+
     def quit(self):
+        import hot_state
+        import tasks
+
         self.game.status = Status.ABANDONED
+        round_number = self.game.current_round
         db.session.add_all([self, self.game])
         db.session.commit()
+        status_cache.clear(self.game_id, round_number)
+        hot_state.evict(self.game_id)
         tasks.abandon_game.apply_async(args=[self.game.id, self.phone])
 
 
 class GameRound(db.Model):
     __tablename__ = "rounds"
+    __table_args__ = (
+        # one row per player per round, however many times a round is started
+        db.UniqueConstraint(
+            "game_id", "round_number", "player", name="uq_rounds_game_round_player"
+        ),
+        # only rows still waiting on a response, for status checks
+        db.Index(
+            "ix_rounds_game_round_pending",
+            "game_id",
+            "round_number",
+            postgresql_where=db.text("data IS NULL"),
+            sqlite_where=db.text("data IS NULL"),
+        ),
+    )
     id = db.Column(db.Integer, autoincrement=True, primary_key=True)
     game_id = db.Column(db.String(4), db.ForeignKey("games.id"), nullable=False)
     player = db.Column(db.Integer, db.ForeignKey("players.id"))
@@ -237,11 +363,107 @@ class GameRound(db.Model):
     turn_type = db.Column(db.Enum(TurnType))
     prompt_sent = db.Column(db.Boolean)
     prompt_sid = db.Column(db.String(40))
+    # latest Twilio status for the prompt (see delivery.py), and how many times
+    # it has been sent
+    prompt_status = db.Column(db.String(16))
+    prompt_attempts = db.Column(db.Integer, default=1, server_default="1")
+    # name of the local copy of a drawing in the media store, once mirrored
+    media_file = db.Column(db.String(80))
 
     game = db.relationship("Game", backref="rounds")
 
 
+class GameArchive(db.Model):
+    """A finished game compacted into one row once its rounds and players rows
+    are deleted: a zlib-compressed JSON document of its play order, players and
+    gallery chains."""
+
+    __tablename__ = "game_archives"
+
+    game_id = db.Column(db.String(4), db.ForeignKey("games.id"), primary_key=True)
+    archived_at = db.Column(db.DateTime)
+    document = db.Column(db.LargeBinary)
+
+    game = db.relationship(
+        "Game", backref=db.backref("archive", uselist=False, lazy="select")
+    )
+
+    @staticmethod
+    def pack(document):
+        return zlib.compress(json.dumps(document, separators=(",", ":")).encode())
+
+    def load(self):
+        return json.loads(zlib.decompress(self.document))
+
+
+class TurnRouting:
+    """
+    Who passes what to whom, answered without scanning play_order.
+
+    play_order[chain][round] is the player who works on that chain in that
+    round, and the index maps each player to their chain in every round, so a
+    player's chain and predecessor in any round are direct lookups.
+    """
+
+    def __init__(self, play_order, index=None):
+        self.play_order = play_order
+        if index is None:
+            # games started before the index was stored
+            index = self.build_index(play_order)
+        # JSON object keys come back as strings
+        self.index = {int(player_id): chains for player_id, chains in index.items()}
+
+    @staticmethod
+    def build_index(play_order):
+        index = {}
+        for chain, order in enumerate(play_order):
+            for round_number, player_id in enumerate(order):
+                index.setdefault(player_id, [None] * len(order))[round_number] = chain
+        return index
+
+    def chain(self, round_number, player_id):
+        return self.index[player_id][round_number]
+
+    def predecessor(self, round_number, player_id):
+        """The player whose response this player works from, if any."""
+        if round_number == 0:
+            return None
+        return self.play_order[self.chain(round_number, player_id)][round_number - 1]
+
+    @staticmethod
+    def turn_type(round_number):
+        return TurnType.DRAW if round_number % 2 else TurnType.WRITE
+
+
+class PlayerContext:
+    """An active player together with their eager-loaded game state."""
+
+    def __init__(self, player):
+        self.player = player
+        self.game = player.game
+        self.current_round = next(
+            (r for r in self.game.current_rounds if r.player == player.id), None
+        )
+        # players whose responses are in the hot state but not yet written
+        self.responded = set()
+        # loaded inside replica_reads() from a configured replica
+        self.from_replica = False
+
+    @property
+    def waiting_for_response(self):
+        return (
+            self.current_round is not None
+            and self.current_round.data is None
+            and self.player.id not in self.responded
+        )
+
+    @property
+    def waiting_on_players(self):
+        responded = {p.phone for p in self.game.players if p.id in self.responded}
+        return [p for p in self.game.waiting_on_players if p not in responded]
+
+
 if __name__ == "__main__":
-    from server import connect_to_db
+    from server import create_app
 
-    connect_to_db()
+    create_app().app_context().push()
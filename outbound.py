@@ -0,0 +1,107 @@
+"""
+Outbound sender pool and rate scheduler.
+
+Each number in TWILIO_NUMBERS can only send so many messages a second, so
+every send first reserves a slot on its number's token bucket and waits until
+that slot comes up. Buckets live in Redis so all web and worker processes
+share them. A game is assigned one sender when it is created and keeps it, so
+its players always hear from (and reply to) the same number, while games as a
+whole are spread across the pool.
+
+Time comes from an injectable clock and waiting from an injectable sleep, so
+the scheduler can be driven with fake ones.
+"""
+
+import logging
+import time
+import zlib
+
+import redis
+
+import twilio_conf
+from store import get_redis
+
+logger = logging.getLogger(__name__)
+
+# GCRA, reserving the next slot even if it's in the future.
+# KEYS[1]: the number's bucket. ARGV: now, seconds per message, burst size.
+# Returns how long to wait, as a string since Lua numbers would be truncated.
+RESERVE_SCRIPT = """
+local now = tonumber(ARGV[1])
+local interval = tonumber(ARGV[2])
+local burst = tonumber(ARGV[3])
+local tat = tonumber(redis.call('GET', KEYS[1]) or ARGV[1])
+if tat < now then tat = now end
+tat = tat + interval
+redis.call('SET', KEYS[1], tostring(tat), 'PX', math.ceil((tat - now) * 1000) + 1000)
+return tostring(math.max(0, tat - now - burst * interval))
+"""
+
+
+class OutboundScheduler:
+    def __init__(
+        self,
+        numbers,
+        rate,
+        burst=1,
+        clock=time.time,
+        sleep=time.sleep,
+        redis_client=None,
+    ):
+        """
+        rate is messages per second per number; 0 turns off rate limiting.
+        clock must agree across processes, hence wall-clock time by default.
+        """
+        if not numbers:
+            raise ValueError("at least one sender number is required")
+        self.numbers = list(numbers)
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.sleep = sleep
+        self.redis_client = redis_client
+        self._reserve = None
+
+    def sender_for(self, game_id):
+        """Pick a game's sender; stored on the game so it stays put."""
+        return self.numbers[zlib.crc32(game_id.encode()) % len(self.numbers)]
+
+    def reserve(self, number):
+        """Reserve the next slot on a number, returning seconds until it."""
+        if not self.rate:
+            return 0
+        try:
+            if self._reserve is None:
+                client = self.redis_client or get_redis()
+                self._reserve = client.register_script(RESERVE_SCRIPT)
+            wait = self._reserve(
+                keys=[f"sender:{number}"],
+                args=[repr(self.clock()), repr(1 / self.rate), self.burst],
+            )
+        except redis.RedisError:
+            # Twilio queues what it can't send right away, so send rather than
+            # drop the message
+            logger.exception(f"could not reserve a send slot on {number}")
+            return 0
+        return float(wait)
+
+    def wait(self, number):
+        delay = self.reserve(number)
+        if delay:
+            self.sleep(delay)
+        return delay
+
+
+scheduler = None
+
+
+def get_scheduler():
+    # assign a stand-in to scheduler to replace it, as with twilio_conf.client
+    global scheduler
+    if scheduler is None:
+        scheduler = OutboundScheduler(
+            twilio_conf.twilio_numbers,
+            twilio_conf.sender_rate,
+            twilio_conf.sender_burst,
+        )
+    return scheduler
@@ -1,56 +1,137 @@
-import datetime as dt
+import functools
 import logging
 import os
 
 from dotenv import load_dotenv
-from flask import Flask, render_template, request, session
-from flask_sqlalchemy import SQLAlchemy
+from flask import (
+    Blueprint,
+    Flask,
+    abort,
+    current_app,
+    render_template,
+    request,
+    send_file,
+)
+from twilio.request_validator import RequestValidator
 from twilio.twiml.messaging_response import MessagingResponse
 
-logger = logging.getLogger(__name__)
+import delivery
+import hot_state
+import inbound
+import media
+import metrics
+import model
+import status_cache
 import tasks
+import tracing
 import twilio_conf
+from database import REPLICA_BIND, db, has_replica, primary, replica_reads
+from gallery import generate_gallery
 
-db = SQLAlchemy()
-
-import model
+logger = logging.getLogger(__name__)
 
 load_dotenv()
 
+bp = Blueprint("game", __name__)
+
+
+def engine_options():
+    """
+    Connection pool settings, per process.
+
+    Each web or Celery worker process holds up to DB_POOL_SIZE + DB_MAX_OVERFLOW
+    connections, so size them against the database's connection limit.
+    """
+    options = {
+        "pool_pre_ping": os.environ.get("DB_POOL_PRE_PING", "true").lower() == "true",
+        "pool_recycle": int(os.environ.get("DB_POOL_RECYCLE", 1800)),
+    }
+    if not (os.environ.get("DATABASE_PATH") or "").startswith("sqlite"):
+        options["pool_size"] = int(os.environ.get("DB_POOL_SIZE", 5))
+        options["max_overflow"] = int(os.environ.get("DB_MAX_OVERFLOW", 10))
+    return options
+
+
+def create_app(config=None):
+    app = Flask(__name__)
+    app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get("DATABASE_PATH")
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options()
+    if os.environ.get("DATABASE_REPLICA_PATH"):
+        app.config["SQLALCHEMY_BINDS"] = {
+            REPLICA_BIND: os.environ["DATABASE_REPLICA_PATH"]
+        }
+    app.config["SMS_ASYNC"] = os.environ.get("SMS_ASYNC", "false").lower() == "true"
+    # Reject webhook posts without a valid X-Twilio-Signature. Off unless
+    # asked for: the signature covers the public URL Twilio posted to, which
+    # is taken from EIP or else the proxy's X-Forwarded-Proto and Host headers.
+    app.config["TWILIO_VALIDATE_SIGNATURES"] = (
+        os.environ.get("TWILIO_VALIDATE_SIGNATURES", "false").lower() == "true"
+    )
+    app.config.update(config or {})
+    db.init_app(app)
+    metrics.init_app(app)
+    app.register_blueprint(bp)
+    return app
+
+
+MEDIA_MAX_AGE = 365 * 24 * 60 * 60
 
-app = Flask(__name__)
-app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
-app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get("DATABASE_PATH")
-db = SQLAlchemy(app)
 
+def read_only(view):
+    """Serve a view that never writes from the read replica."""
 
-def generate_gallery(game):
-    data = []
-    for i, order in enumerate(game.play_order):
-        items = [i]
-        for i, player_id in enumerate(order):
-            round = model.GameRound.query.filter_by(
-                game_id=game.id, player=player_id, round_number=i
-            ).first()
-            if round:
-                items.append(round.data)
-            else:
-                items.append(None)
-        data.append(items)
-    return data
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        with replica_reads():
+            return view(*args, **kwargs)
 
+    return wrapper
 
-@app.route("/")
+
+def webhook_url():
+    """The URL Twilio posted to, which is what it signs."""
+    # behind nginx request.url has the internal scheme and host
+    if os.environ.get("EIP"):
+        base = os.environ["EIP"].rstrip("/")
+    else:
+        scheme = request.headers.get("X-Forwarded-Proto", request.scheme)
+        host = request.headers.get("X-Forwarded-Host", request.host)
+        base = f"{scheme}://{host}"
+    url = base + request.path
+    if request.query_string:
+        url += "?" + request.query_string.decode()
+    return url
+
+
+def twilio_webhook(view):
+    """Only serve requests signed with the Twilio auth token."""
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if current_app.config["TWILIO_VALIDATE_SIGNATURES"]:
+            validator = RequestValidator(os.environ["TWILIO_AUTH_TOKEN"])
+            signature = request.headers.get("X-Twilio-Signature", "")
+            if not validator.validate(webhook_url(), request.form, signature):
+                logger.warning(f"rejected unsigned webhook post to {request.path}")
+                abort(403)
+        return view(*args, **kwargs)
+
+    return wrapper
+
+
+@bp.route("/")
 def home():
     return render_template("home.html", twilio_num=twilio_conf.twilio_num)
 
 
-@app.route("/help")
+@bp.route("/help")
 def show_help():
     return render_template("help.html")
 
 
-@app.route("/gallery/<game_id>")
+@bp.route("/gallery/<game_id>")
+@read_only
 def gallery(game_id):
     game = model.Game.query.get(game_id)
     if not game:
@@ -59,7 +140,28 @@ def gallery(game_id):
     return render_template("gallery.html", data=data)
 
 
-@app.route("/join/<game_id>")
+@bp.route("/media/<name>")
+def show_media(name):
+    if not media.MEDIA_NAME.match(name) or not os.path.exists(media.path_for(name)):
+        abort(404)
+    # content-addressed files never change
+    return send_file(
+        media.path_for(name),
+        max_age=MEDIA_MAX_AGE,
+        etag=name,
+        conditional=True,
+    )
+
+
+@bp.app_template_filter("thumbnail")
+def thumbnail(url):
+    if url and url.startswith("/media/"):
+        return "/media/" + media.thumbnail_name(url[len("/media/") :])
+    return url
+
+
+@bp.route("/join/<game_id>")
+@read_only
 def join_game(game_id):
     game = model.Game.query.get(game_id)
     if not game:
@@ -67,8 +169,9 @@ def join_game(game_id):
     if game.status != model.Status.CREATED:
         return "That game has already started and cannot be joined."
     message = f"Join%20{game_id}"
+    # the game's own sender, so joining players text the number it texts from
     return render_template(
-        "join.html", to=twilio_conf.twilio_num, message=message, game_id=game_id
+        "join.html", to=game.from_number, message=message, game_id=game_id
     )
 
 
@@ -81,177 +184,234 @@ def format_response(msg):
 def handle_empty_state(body, phone):
     if body.lower() == "create":
         game = model.Game.create_game(phone)
-        return format_response(
+        tracing.tag(game_id=game.id)
+        return (
             f"Game created. Send this join link to your friends: {os.environ.get('EIP')}/join/{game.id}\n"
             f"Text START when everyone has joined to begin the game."
         )
     elif body.lower().startswith("join"):
         game_id = body.split(" ")[-1]
         if len(game_id) != 4:
-            return format_response("Did not understand game ID.")
+            return "Did not understand game ID."
         game = model.Game.query.get(game_id)
         if not game:
-            return format_response("That game does not exist.")
+            return "That game does not exist."
         if game.status != model.Status.CREATED:
-            return format_response(
-                "That game has already started and cannot be joined."
-            )
-        player = game.add_player(phone)
+            return "That game has already started and cannot be joined."
+        tracing.tag(game_id=game.id)
+        player = game.add_player(phone, check_other_games=False)
         if not player:
-            return format_response("Error adding player, please try again.")
-        return format_response(
-            f"Joined game. You will receive a message when the game has started. Visit {os.environ.get('EIP')}/help to view rules."
-        )
+            return "Error adding player, please try again."
+        return f"Joined game. You will receive a message when the game has started. Visit {os.environ.get('EIP')}/help to view rules."
     elif body.lower().startswith("status"):
-        return format_response("You are not playing a game, status not available.")
+        return "You are not playing a game, status not available."
     elif body.lower() == "start":
-        return format_response(
-            "Cannot start a game, you have not created one yet. Text CREATE to create a game."
-        )
+        return "Cannot start a game, you have not created one yet. Text CREATE to create a game."
     elif body.lower() == "leave":
-        return format_response("You are not playing a game.")
+        return "You are not playing a game."
     elif body.lower() == "repeat prompt":
-        return format_response("You are not playing a game.")
-    return format_response(
-        f"Telephone Pictionary -- visit {os.environ.get('EIP')}/help to view rules."
-    )
+        return "You are not playing a game."
+    return f"Telephone Pictionary -- visit {os.environ.get('EIP')}/help to view rules."
+
+
+def format_status(current_round, num_players, waiting_phones):
+    num_waiting = len(waiting_phones)
+    waiting_players = "\n".join(waiting_phones)
+    message = f"On round {current_round + 1} of {num_players}, waiting on {num_waiting} players to send responses"
+    if waiting_players:
+        message += ":\n" + waiting_players
+    return message
+
+
+def status_from_context(context):
+    """Answer STATUS from the database, caching the snapshot for next time."""
+    game = context.game
+    phones = [p.phone for p in game.players]
+    waiting = context.waiting_on_players
+    # a replica's rows can be behind the snapshot other requests share
+    if not context.from_replica:
+        status_cache.prime(
+            game.id, game.current_round, phones, waiting, only_if_missing=True
+        )
+    return format_status(game.current_round, len(phones), waiting)
 
 
-def handle_joined_game_not_started(body, phone, player):
+def handle_joined_game_not_started(body, phone, context):
+    player = context.player
     if body.lower().startswith("join"):
-        return format_response("You have already joined a game.")
+        return "You have already joined a game."
     elif body.lower() == "start":
         if player.is_host:
-            if len(player.game.players) <= 1:
-                return format_response("There are no other players. Cannot start game.")
-            player.game.start_game()
+            if len(context.game.players) <= 1:
+                return "There are no other players. Cannot start game."
+            context.game.start_game()
         else:
-            return format_response("Only the host can start the game.")
+            return "Only the host can start the game."
     elif "status" == body.lower():
-        return format_response("Waiting for host to start the game.")
+        return "Waiting for host to start the game."
     elif body.lower() == "repeat prompt":
-        return format_response(
-            "The game has not started, you have not received a prompt yet."
-        )
+        return "The game has not started, you have not received a prompt yet."
     elif body.lower() == "leave":
         player.quit()
 
 
-def handle_playing_submitted_response(body, phone, player):
-    if (
+def starts_another_game(body):
+    return (
         body.lower() == "create"
         or body.lower() == "start"
         or (body.lower().startswith("join") and len(body) == 9)
-    ):
-        return format_response(
-            "You are in another game and must quit (text LEAVE) or complete before starting another."
-        )
+    )
+
+
+IN_ANOTHER_GAME = "You are in another game and must quit (text LEAVE) or complete before starting another."
+RECEIVED = "Received. Waiting for next round to start."
+
+
+def handle_playing_submitted_response(body, phone, context):
+    if starts_another_game(body):
+        return IN_ANOTHER_GAME
     elif "status" == body.lower():
-        game = player.game
-        num_players = len(game.players)
-        num_waiting = num_players - game.current_round_responses
-        waiting_players = "\n".join(game.waiting_on_players)
-        message = f"On round {game.current_round + 1} of {num_players}, waiting on {num_waiting} players to send responses"
-        if waiting_players:
-            message += ":\n" + waiting_players
-        return format_response(message)
+        return status_from_context(context)
     elif body.lower() == "leave":
-        player.quit()
+        context.player.quit()
     elif body.lower() == "repeat prompt":
-        return format_response("You have already submitted a response for this round.")
+        return "You have already submitted a response for this round."
 
 
-def handle_playing_waiting_for_response(body, phone, media, player):
+def handle_playing_waiting_for_response(body, phone, media, context):
+    player = context.player
+    game = context.game
     if media and body:
-        return format_response("Please send either an image or text, not both.")
+        return "Please send either an image or text, not both."
     elif "status" == body.lower():
-        game = player.game
-        num_players = len(game.players)
-        num_waiting = num_players - game.current_round_responses
-        waiting_players = "\n".join(game.waiting_on_players)
-        message = f"On round {game.current_round + 1} of {num_players}, waiting on {num_waiting} players to send responses"
-        if waiting_players:
-            message += ":\n" + waiting_players
-        return format_response(message)
+        return status_from_context(context)
     elif body.lower() == "leave":
         player.quit()
+        return
     elif body.lower() == "repeat prompt" or body.lower() == "resend prompt":
-        game = player.game
-        for turn in player.game.play_order:
-            if turn[game.current_round] != player.id:
-                continue
-            receiving_from_player = turn[game.current_round - 1]
-            last_round = model.GameRound.query.filter_by(
-                player=receiving_from_player,
-                game_id=player.game_id,
-                round_number=game.current_round - 1,
-            ).first()
-            action = "DRAW" if game.current_round % 2 else "DESCRIBE the image"
-            body = f"{action}"
-            media = None
-            if action == "DESCRIBE the image":
-                media = last_round.data
-            else:
-                body += f' "{last_round.data}"'
-            tasks.send_sms.apply_async(
-                args=[body, media, twilio_conf.twilio_num, player.phone, None]
-            )
-    player.game.add_player_response(player.id, media, body)
-    return format_response("Received. Waiting for next round to start.")
-
-
-@app.route("/sms", methods=["POST"])
+        round = context.current_round
+        if round.prompt_status in delivery.IN_FLIGHT_STATUSES:
+            return "Your prompt is on its way."
+        prompt, prompt_media = tasks.prompt_for(game, player.id)
+        # track delivery of the new message instead of the old one
+        round.prompt_sid = delivery.AWAITING_SID
+        round.prompt_status = None
+        round.prompt_attempts = (round.prompt_attempts or 1) + 1
+        db.session.commit()
+        tasks.send_sms.apply_async(
+            args=[prompt, prompt_media, game.from_number, player.phone, round.id],
+            queue=tasks.PROMPTS_QUEUE,
+        )
+        return
+    game.add_player_response(context.current_round, media, body)
+    return RECEIVED
+
+
+def handle_hot_response(phone, body, media):
+    """
+    Record a response in the hot state, returning the reply, or MISS to handle
+    the text from the database instead.
+    """
+    outcome = hot_state.respond(phone, body, media)
+    if outcome == hot_state.RECORDED:
+        return RECEIVED
+    if outcome == hot_state.IGNORED:
+        # already responded, or the next round hasn't started
+        return IN_ANOTHER_GAME if starts_another_game(body) else None
+    return hot_state.MISS
+
+
+@bp.route("/sms/status", methods=["POST"])
+@twilio_webhook
+def receive_status():
+    """Twilio delivery receipt for a prompt; buffered and applied in bulk."""
+    round_id = request.args.get("round_id", type=int)
+    if round_id:
+        delivery.record(
+            round_id, request.form.get("MessageSid"), request.form.get("MessageStatus")
+        )
+    return "", 204
+
+
+def handle_sms(phone, body, media):
+    """Apply one inbound text to the game state, returning the reply, if any."""
+    hot = hot_state.ENABLED and hot_state.is_response(body, media)
+    if hot:
+        reply = handle_hot_response(phone, body, media)
+        if reply != hot_state.MISS:
+            return reply
+    if body.lower() == "status":
+        snapshot = status_cache.lookup(phone)
+        if snapshot:
+            return format_status(*snapshot)
+        # STATUS only reads, and a replica a moment behind is fine for it,
+        # unless it may not have the player's own response yet
+        fresh = status_cache.responded_recently(phone)
+        with primary() if fresh else replica_reads():
+            context = model.GamePlayer.active_context(phone)
+        if context:
+            context.from_replica = not fresh and has_replica(current_app)
+    else:
+        context = model.GamePlayer.active_context(phone)
+    if not context:
+        return handle_empty_state(body, phone)
+    tracing.tag(game_id=context.game.id)
+
+    if hot_state.ENABLED and context.game.status == model.Status.IN_PROGRESS:
+        if hot:
+            # rebuild the game's hot state if it was lost, then go through it
+            hot_state.load(context.game, missing_only=True)
+            reply = handle_hot_response(phone, body, media)
+            if reply != hot_state.MISS:
+                return reply
+        context.responded = hot_state.responded(
+            context.game.id, context.game.current_round
+        )
+
+    if context.game.status == model.Status.CREATED:
+        return handle_joined_game_not_started(body, phone, context)
+    elif context.waiting_for_response:
+        return handle_playing_waiting_for_response(body, phone, media, context)
+    else:
+        return handle_playing_submitted_response(body, phone, context)
+
+
+@bp.route("/sms", methods=["POST"])
+@twilio_webhook
 def receive_sms():
     phone = request.form.get("From").lstrip("+1")
     body = request.form.get("Body").strip()
     media = request.form.get("MediaUrl0")
     logger.info(f"Received sms with body {body}, media {media}, from {phone}")
-    already_playing = model.GamePlayer.playing_other_game(phone)
-    if not already_playing:
-        return handle_empty_state(body, phone)
-
-    player = (
-        model.GamePlayer.query.join(model.Game)
-        .filter(
-            model.Game.status.in_(["CREATED", "STARTED", "IN_PROGRESS"]),
-            model.GamePlayer.phone == phone,
-        )
-        .first()
-    )
-    if player and player.game.status == model.Status.CREATED:
-        return (
-            handle_joined_game_not_started(body, phone, player) or MessagingResponse()
-        )
-    elif player and player.game.status in [
-        model.Status.STARTED,
-        model.Status.IN_PROGRESS,
-    ]:
-        game = player.game
-        player_current_round = model.GameRound.query.filter_by(
-            game_id=game.id, round_number=game.current_round, player=player.id
-        ).first()
-        if player_current_round and not player_current_round.data:
-            return (
-                handle_playing_waiting_for_response(body, phone, media, player)
-                or MessagingResponse()
-            )
+    sid = request.form.get("MessageSid")
+    if sid:
+        stored = inbound.claim(sid)
+        if stored is not None:
+            logger.info(f"{sid} is a retry, replying as before")
+            return stored or str(MessagingResponse())
+
+    try:
+        if current_app.config["SMS_ASYNC"]:
+            # acknowledge now; the reply is texted once the game's queue gets to
+            # it, from the number the player texted
+            reply_from = request.form.get("To") or twilio_conf.twilio_num
+            tasks.enqueue_sms(phone, body, media, reply_from)
+            twiml = str(MessagingResponse())
         else:
-            return (
-                handle_playing_submitted_response(body, phone, player)
-                or MessagingResponse()
-            )
-
-    return MessagingResponse()
-
-
-def connect_to_db():
-    app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get("DATABASE_PATH")
-    db.app = app
-    db.init_app(app)
-    db.create_all()
+            reply = handle_sms(phone, body, media)
+            twiml = format_response(reply) if reply else str(MessagingResponse())
+    except:
+        if sid:
+            inbound.release(sid)
+        raise
+    if sid:
+        inbound.remember(sid, twiml)
+    return twiml
 
 
 if __name__ == "__main__":
-    db_path = os.environ.get("DATABASE_PATH")
-    connect_to_db()
+    # development server; production runs wsgi:app under gunicorn
+    app = create_app()
+    with app.app_context():
+        db.create_all()
     app.run(debug=True)
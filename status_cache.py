@@ -0,0 +1,139 @@
+"""
+Cached STATUS snapshots for rounds in progress.
+
+Each round has a snapshot in Redis holding the number of players and the set
+of phones still waiting to respond, plus a pointer from each player's phone to
+their game's snapshot. Rounds are primed when they start, responses remove
+the phone from the waiting set, and snapshots are dropped when a round or game
+ends, so answering STATUS takes one script call. A missing snapshot is rebuilt
+from the database.
+
+Responses are also added to an answered set, even while the snapshot is
+missing, and lookups leave those phones out. A rebuild from rows read before a
+response committed therefore can't list that player as waiting again. For a
+while after responding, a player's own rebuilds read from the primary, since a
+replica may not have their response yet.
+"""
+
+import logging
+import os
+
+import redis
+
+from store import get_redis
+
+logger = logging.getLogger(__name__)
+
+# bounds how long a snapshot can be stale if an update is ever missed
+STATUS_CACHE_TTL = int(os.environ.get("STATUS_CACHE_TTL", 3600))
+# how long after responding a player's STATUS rebuilds read from the primary,
+# which should cover the replica's lag
+RESPONDED_RECENTLY_SECONDS = int(os.environ.get("RESPONDED_RECENTLY_SECONDS", 30))
+
+# KEYS[1]: the phone's pointer. Returns [game_id:round, players, waiting phones].
+LOOKUP_SCRIPT = """
+local snapshot = redis.call('GET', KEYS[1])
+if not snapshot then return nil end
+local key = 'status:' .. snapshot
+local players = redis.call('HGET', key, 'players')
+if not players then return nil end
+return {snapshot, players, redis.call('SDIFF', key .. ':waiting', key .. ':answered')}
+"""
+
+_lookup = None
+
+
+def _snapshot_key(game_id, round_number):
+    return f"status:{game_id}:{round_number}"
+
+
+def _phone_key(phone):
+    return f"status:phone:{phone}"
+
+
+def _responded_key(phone):
+    return f"status:responded:{phone}"
+
+
+def prime(game_id, round_number, phones, waiting=None, only_if_missing=False):
+    """
+    Store a round's snapshot and point each player's phone at it.
+
+    With only_if_missing, a snapshot that is already there is left alone, for
+    rebuilds from rows that may be older than it.
+    """
+    key = _snapshot_key(game_id, round_number)
+    waiting = phones if waiting is None else waiting
+    try:
+        with get_redis().pipeline() as pipe:
+            if only_if_missing:
+                pipe.watch(key)
+                if pipe.exists(key):
+                    return
+                pipe.multi()
+            pipe.delete(f"{key}:waiting")
+            pipe.hset(key, "players", len(phones))
+            if waiting:
+                pipe.sadd(f"{key}:waiting", *waiting)
+            pipe.expire(key, STATUS_CACHE_TTL)
+            pipe.expire(f"{key}:waiting", STATUS_CACHE_TTL)
+            for phone in phones:
+                pipe.set(
+                    _phone_key(phone), f"{game_id}:{round_number}", ex=STATUS_CACHE_TTL
+                )
+            pipe.execute()
+    except redis.WatchError:
+        # primed by someone else in the meantime
+        pass
+    except redis.RedisError:
+        logger.exception("could not store status snapshot")
+
+
+def record_response(game_id, round_number, phone):
+    key = _snapshot_key(game_id, round_number)
+    try:
+        pipe = get_redis().pipeline()
+        pipe.srem(f"{key}:waiting", phone)
+        pipe.sadd(f"{key}:answered", phone)
+        pipe.expire(f"{key}:answered", STATUS_CACHE_TTL)
+        pipe.set(_responded_key(phone), 1, ex=RESPONDED_RECENTLY_SECONDS)
+        pipe.execute()
+    except redis.RedisError:
+        logger.exception("could not update status snapshot")
+
+
+def responded_recently(phone):
+    """
+    Whether the player responded recently enough that a replica may not have
+    their response yet. Assumes so if Redis is unavailable.
+    """
+    try:
+        return bool(get_redis().exists(_responded_key(phone)))
+    except redis.RedisError:
+        logger.exception("could not check for a recent response")
+        return True
+
+
+def clear(game_id, round_number):
+    key = _snapshot_key(game_id, round_number)
+    try:
+        get_redis().delete(key, f"{key}:waiting", f"{key}:answered")
+    except redis.RedisError:
+        logger.exception("could not clear status snapshot")
+
+
+def lookup(phone):
+    """Return (round_number, num_players, waiting phones) or None on a miss."""
+    global _lookup
+    try:
+        if _lookup is None:
+            _lookup = get_redis().register_script(LOOKUP_SCRIPT)
+        result = _lookup(keys=[_phone_key(phone)])
+    except redis.RedisError:
+        logger.exception("could not read status snapshot")
+        return None
+    if not result:
+        return None
+    snapshot, players, waiting = result
+    round_number = int(snapshot.rsplit(":", 1)[1])
+    return round_number, int(players), sorted(waiting)
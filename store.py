@@ -0,0 +1,18 @@
+import os
+
+import redis
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Shared Redis used for cross-worker state. Kept apart from the Celery broker db.
+REDIS_URL = os.environ.get("REDIS_URL", "redis://localhost:6379/2")
+
+_client = None
+
+
+def get_redis():
+    global _client
+    if _client is None:
+        _client = redis.Redis.from_url(REDIS_URL, decode_responses=True)
+    return _client
@@ -1,115 +1,612 @@
+import contextvars
+import datetime as dt
+import logging
 import os
+import time
+import zlib
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
-from celery import Celery
+import requests
+from celery import Celery, Task
 from celery.schedules import crontab
+from flask import has_app_context
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import aliased, contains_eager, joinedload
 
+import archive
+import delivery
+import gallery
+import game_ids
+import hot_state
+import media
+import metrics
 import model
-from server import connect_to_db, db
-from twilio_conf import client, twilio_num
+import outbound
+import status_cache
+import tracing
+import twilio_conf
+from database import db
+from twilio_conf import twilio_num
+
+logger = logging.getLogger(__name__)
+
+_flask_app = None
+
+
+def get_flask_app():
+    # Built on first use, which in a prefork worker is after the fork, so each
+    # process opens its own database connections.
+    global _flask_app
+    if _flask_app is None:
+        from server import create_app
+
+        _flask_app = create_app()
+    return _flask_app
+
+
+class AppContextTask(Task):
+    def __call__(self, *args, **kwargs):
+        # eager tasks already run inside the calling request's app context
+        if has_app_context():
+            return super().__call__(*args, **kwargs)
+        with get_flask_app().app_context():
+            return super().__call__(*args, **kwargs)
 
-connect_to_db()
 
 BROKER_URL = "redis://localhost:6379/0"
 BACKEND_URL = "redis://localhost:6379/1"
-celery_app = Celery("tasks", broker=BROKER_URL, backend=BACKEND_URL)
+celery_app = Celery(
+    "tasks", broker=BROKER_URL, backend=BACKEND_URL, task_cls=AppContextTask
+)
 
+# Round transitions, prompts and informational notifications each get their
+# own queue and workers (see conf/), so a burst of game-over or abandoned-game
+# texts can't hold up the next round's prompts for games still being played.
+# send_sms and send_sms_batch default to notifications; prompt sends pass
+# queue=PROMPTS_QUEUE.
+ROUNDS_QUEUE = "rounds"
+PROMPTS_QUEUE = "prompts"
+NOTIFICATIONS_QUEUE = "notifications"
+MAINTENANCE_QUEUE = "maintenance"
+
+celery_app.conf.update(
+    task_routes={
+        "tasks.start_game": {"queue": ROUNDS_QUEUE},
+        "tasks.start_new_round": {"queue": ROUNDS_QUEUE},
+        "tasks.flush_hot_game": {"queue": ROUNDS_QUEUE},
+        "tasks.send_sms": {"queue": NOTIFICATIONS_QUEUE},
+        "tasks.send_sms_batch": {"queue": NOTIFICATIONS_QUEUE},
+        "tasks.abandon_game": {"queue": NOTIFICATIONS_QUEUE},
+        "tasks.send_round_update": {"queue": NOTIFICATIONS_QUEUE},
+        "tasks.send_gallery_view": {"queue": NOTIFICATIONS_QUEUE},
+        "tasks.*": {"queue": MAINTENANCE_QUEUE},
+    },
+    # nothing reads task results
+    task_ignore_result=True,
+    worker_prefetch_multiplier=int(os.environ.get("CELERY_PREFETCH_MULTIPLIER", 1)),
+    task_acks_late=os.environ.get("CELERY_ACKS_LATE", "").lower() == "true",
+)
+# How often buffered delivery receipts are written to the rounds table.
+DELIVERY_FLUSH_SECONDS = float(os.environ.get("DELIVERY_FLUSH_SECONDS", 10))
+# A prompt that couldn't be delivered is re-sent until it has been sent this
+# many times.
+MAX_PROMPT_ATTEMPTS = int(os.environ.get("MAX_PROMPT_ATTEMPTS", 3))
+
+celery_app.conf.beat_schedule = {
+    "recycle-game-ids": {
+        "task": "tasks.recycle_game_ids",
+        "schedule": crontab(hour=4, minute=0),
+    },
+    "reap-stale-games": {
+        "task": "tasks.reap_stale_games",
+        "schedule": crontab(minute="*/15"),
+    },
+    "flush-delivery-statuses": {
+        "task": "tasks.flush_delivery_statuses",
+        "schedule": DELIVERY_FLUSH_SECONDS,
+    },
+    "resend-undelivered-prompts": {
+        "task": "tasks.resend_undelivered_prompts",
+        "schedule": crontab(),
+    },
+    "archive-finished-games": {
+        "task": "tasks.archive_finished_games",
+        "schedule": crontab(minute=30),
+    },
+}
+if hot_state.ENABLED:
+    celery_app.conf.beat_schedule["flush-hot-state"] = {
+        "task": "tasks.flush_hot_state",
+        "schedule": hot_state.HOT_STATE_FLUSH_SECONDS,
+    }
+
+# Inbound texts are processed on SMS_SHARDS queues (sms.0, sms.1, ...), each
+# consumed by a single-process worker, so texts for one game apply in order.
+SMS_SHARDS = int(os.environ.get("SMS_SHARDS", 4))
+
+# Days a finished game (and its gallery) is kept before its id can be reused.
+GAME_ID_RETENTION_DAYS = int(os.environ.get("GAME_ID_RETENTION_DAYS", 30))
+RECYCLE_BATCH_SIZE = 1000
+
+# Hours an unfinished game can go without a join, start or response before it
+# is abandoned, freeing its players to join other games.
+STALE_GAME_HOURS = float(os.environ.get("STALE_GAME_HOURS", 24))
+REAP_BATCH_SIZE = 500
 
-@celery_app.task
-def update_round_information(round_id, message_sid):
-    round = model.GameRound.query.get(round_id)
-    round.prompt_sent = True
-    round.prompt_sid = message_sid
-    try:
-        db.session.add(round)
-        db.session.commit()
-    except:
-        db.session.rollback()
-    finally:
-        db.session.close()
+
+_sms_pool = None
+
+
+def get_sms_pool():
+    # created on first use so each forked worker process gets its own threads
+    global _sms_pool
+    if _sms_pool is None:
+        _sms_pool = ThreadPoolExecutor(max_workers=twilio_conf.sms_pool_size)
+    return _sms_pool
+
+
+def create_message(**kwargs):
+    # wait for a slot on the sender's rate limit
+    with tracing.span("rate_limit_wait"):
+        waited = outbound.get_scheduler().wait(kwargs["from_"])
+    metrics.observe("sms_send_wait_seconds", waited)
+    with metrics.timed("twilio_request_seconds"), tracing.span("twilio"):
+        return twilio_conf.get_client().messages.create(**kwargs)
 
 
 @celery_app.task
 def send_sms(body, media, from_, to, round_id=None):
-    message = client.messages.create(body=body, from_=from_, to=to, media_url=media)
-    # TODO: Session management -- this isn't working right now.
-    # if round_id and message.sid:
-    # update_round_information.apply_async(args=[round_id, message.sid])
+    message = create_message(
+        body=body,
+        from_=from_,
+        to=to,
+        media_url=media,
+        status_callback=delivery.callback_url(round_id) if round_id else None,
+    )
+    if round_id:
+        delivery.record_sent([(round_id, message.sid)])
+
+
+@celery_app.task
+def send_sms_batch(messages, from_=twilio_num):
+    """
+    Send a list of [body, media, to, round_id] messages concurrently, from the
+    game's sender number.
+
+    One failed send is logged and doesn't stop the rest of the batch; failed
+    prompts are marked for re-sending.
+    """
+    pool = get_sms_pool()
+    futures = [
+        # copy the context so each send is recorded in this task's trace
+        pool.submit(
+            contextvars.copy_context().run,
+            create_message,
+            body=body,
+            from_=from_,
+            to=to,
+            media_url=media,
+            status_callback=delivery.callback_url(round_id) if round_id else None,
+        )
+        for body, media, to, round_id in messages
+    ]
+    sent = []
+    failed = []
+    for (body, media, to, round_id), future in zip(messages, futures):
+        try:
+            message = future.result()
+        except Exception:
+            # a connection error or timeout as well as an API error; retrying
+            # the task would send the rest of the batch again
+            logger.exception(f"Failed to send sms to {to} for round {round_id}")
+            if round_id:
+                failed.append(round_id)
+            continue
+        if round_id:
+            sent.append((round_id, message.sid))
+    # matched to delivery receipts when the buffer is next flushed
+    delivery.record_sent(sent)
+    delivery.record_failed(failed)
+    trace = tracing.current()
+    if trace and "transition" in trace:
+        metrics.observe("round_transition_seconds", time.time() - trace["started_at"])
 
 
 @celery_app.task
 def abandon_game(game_id, abandoner):
     game = model.Game.query.get(game_id)
+    messages = []
     for p in game.players:
         if p.phone == abandoner:
             body = f"You have left the game."
         else:
             body = f"A player abandoned the game, it has now ended."
-        send_sms.apply_async(args=[body, None, twilio_num, p.phone, None])
+        messages.append([body, None, p.phone, None])
+    send_sms_batch.delay(messages, game.from_number)
+
+
+def create_rounds(game, rounds):
+    """
+    Insert all of a round's rows in a single transaction.
+
+    Returns the new row ids in the same order as rounds, or None if the round
+    was already created (e.g. the task was retried) or the insert failed.
+    """
+    if game.current_rounds:
+        logger.info(f"round {game.current_round} already started for game {game.id}")
+        db.session.rollback()
+        return None
+    try:
+        db.session.add_all(rounds)
+        db.session.flush()
+        # read ids before commit expires the rows
+        round_ids = [r.id for r in rounds]
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        # another start of the same round got there first
+        logger.info(f"round {game.current_round} already started for game {game.id}")
+        return None
+    except:
+        db.session.rollback()
+        raise
+    return round_ids
+
+
+FIRST_PROMPT = "FIRST ROUND: Respond with a word or phrase."
+
+
+def prompt(round_number, previous):
+    """A round's prompt as (body, media), given the response it works from."""
+    if round_number == 0:
+        return FIRST_PROMPT, None
+    if model.TurnRouting.turn_type(round_number) == model.TurnType.DRAW:
+        return f'DRAW "{previous}"', None
+    return "DESCRIBE the image", previous
+
+
+def prompt_for(game, player_id):
+    """The current round's prompt for a player, as (body, media), for re-sends."""
+    predecessor = game.routing.predecessor(game.current_round, player_id)
+    previous = None
+    if predecessor is not None:
+        previous = (
+            db.session.query(model.GameRound.data)
+            .filter_by(
+                player=predecessor,
+                game_id=game.id,
+                round_number=game.current_round - 1,
+            )
+            .scalar()
+        )
+    return prompt(game.current_round, previous)
 
 
 @celery_app.task
 def start_game(game_id):
     """Send a prompt to everyone to say a word and send it in."""
-    game = model.Game.query.get(game_id)
+    game = model.Game.query.options(joinedload(model.Game.players)).get(game_id)
     game.status = model.Status.IN_PROGRESS
-    for p in game.players:
-        body = "FIRST ROUND: Respond with a word or phrase."
-        round = model.GameRound(
+    body = FIRST_PROMPT
+    phones = [p.phone for p in game.players]
+    rounds = [
+        model.GameRound(
             game_id=game.id,
             player=p.id,
             turn_type=model.TurnType.WRITE,
             round_number=game.current_round,
         )
-        db.session.add(round)
-        db.session.commit()
-        send_sms.apply_async(args=[body, None, twilio_num, p.phone, round.id])
+        for p in game.players
+    ]
+    round_number = game.current_round
+    round_ids = create_rounds(game, rounds)
+    if round_ids is None:
+        return
+    status_cache.prime(game_id, round_number, phones)
+    hot_state.load(game)
+    send_sms_batch.apply_async(
+        args=[
+            [
+                [body, None, phone, round_id]
+                for phone, round_id in zip(phones, round_ids)
+            ],
+            game.from_number,
+        ],
+        queue=PROMPTS_QUEUE,
+    )
 
 
 @celery_app.task
 def start_new_round(game_id):
-    game = model.Game.query.get(game_id)
-    for turn in game.play_order:
-        # ex: [7, 5, 6]
-        receiving_from_player = turn[game.current_round - 1]  # last round's turn
-        send_to_player = turn[game.current_round]
-        send_to_phone = model.GamePlayer.query.get(send_to_player).phone
-        last_round = model.GameRound.query.filter_by(
-            player=receiving_from_player,
-            game_id=game.id,
-            round_number=game.current_round - 1,
-        ).first()
-        action = "DRAW" if game.current_round % 2 else "DESCRIBE the image"
-        body = (
-            f"Starting round {game.current_round + 1} of {len(game.players)}. {action}"
+    game = model.Game.query.options(joinedload(model.Game.players)).get(game_id)
+    phones = {p.id: p.phone for p in game.players}
+    last_rounds = {
+        r.player: r
+        for r in model.GameRound.query.filter_by(
+            game_id=game.id, round_number=game.current_round - 1
         )
-        media = None
-        if action == "DESCRIBE the image":
-            media = last_round.data
-        else:
-            body += f' "{last_round.data}"'
-        round = model.GameRound(
-            game_id=game.id,
-            player=send_to_player,
-            turn_type=model.TurnType.DRAW
-            if game.current_round % 2
-            else model.TurnType.WRITE,
-            round_number=game.current_round,
+    }
+    routing = game.routing
+    turn_type = routing.turn_type(game.current_round)
+    messages = []
+    rounds = []
+    for player_id, phone in phones.items():
+        last_round = last_rounds[routing.predecessor(game.current_round, player_id)]
+        body, media = prompt(game.current_round, last_round.data)
+        body = f"Starting round {game.current_round + 1} of {len(phones)}. {body}"
+        rounds.append(
+            model.GameRound(
+                game_id=game.id,
+                player=player_id,
+                turn_type=turn_type,
+                round_number=game.current_round,
+            )
         )
-        db.session.add(round)
-        db.session.commit()
-        send_sms.apply_async(args=[body, media, twilio_num, send_to_phone, round.id])
+        messages.append([body, media, phone])
+    round_number = game.current_round
+    round_ids = create_rounds(game, rounds)
+    if round_ids is None:
+        return
+    status_cache.prime(game_id, round_number, list(phones.values()))
+    hot_state.load(game)
+    send_sms_batch.apply_async(
+        args=[
+            [message + [round_id] for message, round_id in zip(messages, round_ids)],
+            game.from_number,
+        ],
+        queue=PROMPTS_QUEUE,
+    )
 
 
 @celery_app.task
-def send_round_update(phone_nums, num_remaining):
-    for p in phone_nums:
-        body = f"A player sent a response. Waiting on {num_remaining} other responsesin this round."
-        send_sms.apply_async(args=[body, None, twilio_num, p, None])
+def send_round_update(phone_nums, num_remaining, from_=twilio_num):
+    body = f"A player sent a response. Waiting on {num_remaining} other responses in this round."
+    send_sms_batch.delay([[body, None, p, None] for p in phone_nums], from_)
 
 
 @celery_app.task
 def send_gallery_view(game_id):
     game = model.Game.query.get(game_id)
-    for p in game.players:
-        body = f"Game is over! Visit {os.environ.get('EIP')}/gallery/{game_id} to view the final results."
-        send_sms.apply_async(args=[body, None, twilio_num, p.phone, None])
+    gallery.render_static(game)
+    body = f"Game is over! Visit {os.environ.get('EIP')}/gallery/{game_id} to view the final results."
+    send_sms_batch.delay(
+        [[body, None, p.phone, None] for p in game.players], game.from_number
+    )
+
+
+@celery_app.task
+def recycle_game_ids():
+    """Delete finished games past the retention window and free their ids."""
+    cutoff = dt.datetime.utcnow() - dt.timedelta(days=GAME_ID_RETENTION_DAYS)
+    recycled = 0
+    while True:
+        ids = [
+            id_
+            for id_, in db.session.query(model.Game.id)
+            .filter(
+                model.Game.status.in_(model.FINISHED_STATUSES),
+                model.Game.created_at < cutoff,
+            )
+            .limit(RECYCLE_BATCH_SIZE)
+        ]
+        if not ids:
+            break
+        try:
+            for table in (
+                model.GameRound,
+                model.GamePlayer,
+                model.GameArchive,
+                model.Game,
+            ):
+                column = table.id if table is model.Game else table.game_id
+                table.query.filter(column.in_(ids)).delete(synchronize_session=False)
+            db.session.commit()
+        except:
+            db.session.rollback()
+            raise
+        gallery.remove_static(ids)
+        game_ids.release(ids)
+        recycled += len(ids)
+    logger.info(f"recycled {recycled} game ids")
+    return recycled
+
+
+@celery_app.task
+def reap_stale_games():
+    """Abandon unfinished games with no activity in STALE_GAME_HOURS."""
+    cutoff = dt.datetime.utcnow() - dt.timedelta(hours=STALE_GAME_HOURS)
+    reaped = []
+    while True:
+        # skip games a response is holding the lock on; they aren't stale
+        games = (
+            db.session.query(model.Game.id, model.Game.current_round)
+            .filter(
+                model.Game.status.in_(model.ACTIVE_STATUSES),
+                model.Game.last_activity_at < cutoff,
+            )
+            .limit(REAP_BATCH_SIZE)
+            .with_for_update(skip_locked=True)
+            .all()
+        )
+        if not games:
+            break
+        ids = [id_ for id_, _ in games]
+        try:
+            model.Game.query.filter(model.Game.id.in_(ids)).update(
+                {"status": model.Status.ABANDONED}, synchronize_session=False
+            )
+            players = (
+                db.session.query(model.GamePlayer.phone, model.Game.sender)
+                .join(model.GamePlayer.game)
+                .filter(model.GamePlayer.game_id.in_(ids))
+                .all()
+            )
+            db.session.commit()
+        except:
+            db.session.rollback()
+            raise
+        for id_, current_round in games:
+            status_cache.clear(id_, current_round)
+            hot_state.evict(id_)
+        body = "Your game was ended because nobody played for a while. Text CREATE to start a new one."
+        by_sender = defaultdict(list)
+        for phone, sender in players:
+            by_sender[sender or twilio_num].append([body, None, phone, None])
+        for sender, messages in by_sender.items():
+            send_sms_batch.delay(messages, sender)
+        reaped.extend(ids)
+    logger.info(f"reaped {len(reaped)} stale games: {', '.join(reaped)}")
+    return reaped
+
+
+@celery_app.task
+def archive_finished_games():
+    """Compact finished games out of the hot tables."""
+    archived = archive.backfill()
+    logger.info(f"archived {archived} finished games")
+    return archived
+
+
+@celery_app.task
+def flush_delivery_statuses():
+    return delivery.flush()
+
+
+@celery_app.task
+def resend_undelivered_prompts():
+    """Re-send current-round prompts that couldn't be delivered."""
+    rounds = (
+        model.GameRound.query.join(model.GameRound.game)
+        .options(contains_eager(model.GameRound.game))
+        .filter(
+            model.Game.status == model.Status.IN_PROGRESS,
+            model.GameRound.round_number == model.Game.current_round,
+            model.GameRound.data.is_(None),
+            model.GameRound.prompt_status.in_(delivery.UNDELIVERED_STATUSES),
+            model.GameRound.prompt_attempts < MAX_PROMPT_ATTEMPTS,
+        )
+        .all()
+    )
+    if not rounds:
+        return 0
+    phones = dict(
+        db.session.query(model.GamePlayer.id, model.GamePlayer.phone).filter(
+            model.GamePlayer.id.in_({r.player for r in rounds})
+        )
+    )
+    # the previous round's responses the prompts are made from
+    previous_rounds = aliased(model.GameRound)
+    previous = {
+        (game_id, player): data
+        for game_id, player, data in db.session.query(
+            previous_rounds.game_id, previous_rounds.player, previous_rounds.data
+        )
+        .join(model.Game, model.Game.id == previous_rounds.game_id)
+        .filter(
+            previous_rounds.game_id.in_({r.game_id for r in rounds}),
+            previous_rounds.round_number == model.Game.current_round - 1,
+        )
+    }
+    batches = defaultdict(list)
+    for round in rounds:
+        game = round.game
+        predecessor = game.routing.predecessor(game.current_round, round.player)
+        body, media = prompt(game.current_round, previous.get((game.id, predecessor)))
+        batches[game.from_number].append([body, media, phones[round.player], round.id])
+        # receipts for the failed message no longer apply
+        round.prompt_sid = delivery.AWAITING_SID
+        round.prompt_status = None
+        round.prompt_attempts += 1
+    db.session.commit()
+    for sender, messages in batches.items():
+        send_sms_batch.apply_async(args=[messages, sender], queue=PROMPTS_QUEUE)
+    logger.info(f"re-sent {len(rounds)} undelivered prompts")
+    return len(rounds)
+
+
+def after_flush(game_id, flushed):
+    """Enqueue what follows a hot state flush, as add_player_response would."""
+    if flushed is None:
+        return
+    game, round_over, draws = flushed
+    for round_id, url in draws:
+        mirror_media.delay(round_id, url)
+    if not round_over:
+        return
+    status_cache.clear(game_id, game.current_round - 1)
+    if game.status == model.Status.COMPLETED:
+        hot_state.evict(game_id)
+        send_gallery_view.delay(game_id)
+    else:
+        start_new_round.delay(game_id)
+
+
+@celery_app.task
+def flush_hot_game(game_id):
+    """Write a game's responses once the hot state says its round is over."""
+    after_flush(game_id, hot_state.flush(game_id))
+
+
+@celery_app.task
+def flush_hot_state():
+    """Write every game's responses recorded since the last flush."""
+    dirty = hot_state.dirty_games()
+    for game_id in dirty:
+        # one game failing to flush shouldn't hold up the rest
+        try:
+            after_flush(game_id, hot_state.flush(game_id))
+        except Exception:
+            db.session.rollback()
+            logger.exception(f"could not flush hot state for game {game_id}")
+    return len(dirty)
+
+
+@celery_app.task
+def mirror_media(round_id, url):
+    """Copy a drawing into the local media store for the gallery."""
+    try:
+        name = media.mirror(url)
+    except (
+        requests.RequestException,
+        media.MediaTooLarge,
+        media.UntrustedMediaUrl,
+        OSError,
+    ):
+        # the gallery falls back to the original url
+        logger.exception(f"could not mirror media for round {round_id}")
+        return
+    round = model.GameRound.query.get(round_id)
+    if round is None:
+        # archived first; the gallery keeps the original url
+        return
+    round.media_file = name
+    db.session.commit()
+    # the game may have finished while this was fetching
+    if round.game.status == model.Status.COMPLETED:
+        gallery.render_static(round.game)
+
+
+def sms_queue(key):
+    return f"sms.{zlib.crc32(key.encode()) % SMS_SHARDS}"
+
+
+def enqueue_sms(phone, body, media, reply_from=twilio_num):
+    """Queue an inbound text on the shard for the game it applies to."""
+    game_id = model.GamePlayer.active_game_id(phone)
+    if not game_id and body.lower().startswith("join"):
+        game_id = body.split(" ")[-1]
+    process_sms.apply_async(
+        args=[phone, body, media, reply_from], queue=sms_queue(game_id or phone)
+    )
+
+
+@celery_app.task
+def process_sms(phone, body, media, reply_from=twilio_num):
+    from server import handle_sms
+
+    reply = handle_sms(phone, body, media)
+    if reply:
+        send_sms.apply_async(
+            args=[reply, None, reply_from, phone, None], queue=PROMPTS_QUEUE
+        )
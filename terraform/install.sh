@@ -22,6 +22,8 @@ cd track-jacket-app
 pip3 install --upgrade pip
 pip3 install -r requirements.txt
 createdb telephone-pictionary
+# schema for a fresh database; app.service re-runs it on every start
+python3 migrate.py
 sudo chown ubuntu: /home/ubuntu/track-jacket-app
 sudo rm /etc/nginx/sites-enabled/default
 sudo cp conf/nginx.conf /etc/nginx/sites-enabled/nginx.conf
@@ -35,3 +37,13 @@ sydo systemctl start redis
 sudo cp conf/celery.service /etc/systemd/system/celery.service
 sudo systemctl enable celery
 sudo systemctl start celery
+for queue in rounds prompts notifications; do
+    sudo cp conf/celery-$queue.service /etc/systemd/system/celery-$queue.service
+    sudo systemctl enable celery-$queue
+    sudo systemctl start celery-$queue
+done
+sudo cp conf/celery-sms@.service /etc/systemd/system/celery-sms@.service
+for shard in 0 1 2 3; do
+    sudo systemctl enable celery-sms@$shard
+    sudo systemctl start celery-sms@$shard
+done
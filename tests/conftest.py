@@ -0,0 +1,136 @@
+"""
+Fixtures for running the app against SQLite and fakeredis, with Celery tasks
+run eagerly and Twilio replaced by the load generator's fake client.
+"""
+
+import os
+
+os.environ.setdefault("TWILIO_NUMBER", "+15005550006")
+os.environ.setdefault("TWILIO_ACCOUNT_SID", "AC" + "0" * 32)
+os.environ.setdefault("TWILIO_AUTH_TOKEN", "test-token")
+os.environ.setdefault("TWILIO_SENDER_RATE", "0")
+os.environ.setdefault("DATABASE_PATH", "sqlite://")
+os.environ.setdefault("EIP", "http://example.test")
+
+import fakeredis
+import pytest
+from sqlalchemy import event
+
+import gallery
+import hot_state
+import loadgen
+import media
+import outbound
+import server
+import store
+import tasks
+import twilio_conf
+
+tasks.celery_app.conf.task_always_eager = True
+
+# one client for the whole run, since registered Lua scripts hold on to it
+_redis = fakeredis.FakeRedis(decode_responses=True)
+
+
+@pytest.fixture(autouse=True)
+def redis_client():
+    store._client = _redis
+    _redis.flushall()
+    yield _redis
+
+
+@pytest.fixture(autouse=True)
+def fake_twilio(tmp_path, monkeypatch):
+    monkeypatch.setattr(twilio_conf, "client", loadgen.FakeTwilioClient())
+    monkeypatch.setattr(outbound, "scheduler", None)
+    # drawings are "fetched" from memory into a scratch media store
+    image = loadgen.fake_image()
+    monkeypatch.setattr(media, "fetch", lambda url: (image, "image/png"))
+    monkeypatch.setattr(media, "MEDIA_ROOT", str(tmp_path / "media"))
+    monkeypatch.setattr(gallery, "GALLERY_ROOT", str(tmp_path / "galleries"))
+    monkeypatch.setattr(gallery, "_gallery_cache", type(gallery._gallery_cache)())
+    return twilio_conf.client.messages
+
+
+@pytest.fixture(params=[False, True], ids=["sql", "hot_state"])
+def hot_state_modes(request, monkeypatch):
+    """Run a test with responses going through SQL and through hot_state."""
+    monkeypatch.setattr(hot_state, "ENABLED", request.param)
+    return request.param
+
+
+@pytest.fixture
+def app(tmp_path):
+    app = server.create_app(
+        {
+            "SQLALCHEMY_DATABASE_URI": f"sqlite:///{tmp_path / 'test.db'}",
+            "TWILIO_VALIDATE_SIGNATURES": False,
+        }
+    )
+    with app.app_context():
+        server.db.create_all()
+    yield app
+    with app.app_context():
+        server.db.engine.dispose()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+class QueryCounter:
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, *args, **kwargs):
+        self.count += 1
+
+
+@pytest.fixture
+def count_queries(app):
+    """Count the SQL statements run inside a block:
+
+    with count_queries() as queries:
+        ...
+    queries.count
+    """
+    from contextlib import contextmanager
+
+    with app.app_context():
+        engine = server.db.engine
+
+    @contextmanager
+    def counting():
+        counter = QueryCounter()
+        event.listen(engine, "before_cursor_execute", counter)
+        try:
+            yield counter
+        finally:
+            event.remove(engine, "before_cursor_execute", counter)
+
+    return counting
+
+
+@pytest.fixture
+def deferred_tasks(app, monkeypatch):
+    """
+    Hold Celery tasks published during a block, so only the request's own
+    queries are counted, and run them (and any they publish) on run().
+    """
+    from celery.app.task import Task
+
+    pending = []
+
+    def apply_async(self, args=None, kwargs=None, **options):
+        pending.append((self, args or (), kwargs or {}))
+
+    monkeypatch.setattr(Task, "apply_async", apply_async)
+
+    def run():
+        with app.app_context():
+            while pending:
+                task, args, kwargs = pending.pop(0)
+                task.apply(args, kwargs).get()
+
+    return run
@@ -0,0 +1,44 @@
+"""Driving games through /sms from tests."""
+
+import loadgen
+
+
+def text(client, phone, body, media=None, sid=None):
+    """Post an inbound text to /sms, returning the TwiML reply."""
+    data = {"From": f"+1{phone}", "Body": body}
+    if media:
+        data["MediaUrl0"] = media
+    if sid:
+        data["MessageSid"] = sid
+    response = client.post("/sms", data=data)
+    assert response.status_code == 200
+    return response.get_data(as_text=True)
+
+
+def phones_for(num_players, prefix="555"):
+    return [f"{prefix}{i:07d}" for i in range(num_players)]
+
+
+def start_game(client, phones):
+    """Create a game, join everyone and start it, returning the game id."""
+    reply = text(client, phones[0], "create")
+    game_id = loadgen.JOIN_LINK.search(reply).group(1)
+    for phone in phones[1:]:
+        text(client, phone, f"join {game_id}")
+    text(client, phones[0], "start")
+    return game_id
+
+
+def play_round(client, phones, round_number):
+    for i, phone in enumerate(phones):
+        if round_number % 2:
+            text(client, phone, "", f"https://api.twilio.com/{round_number}/{i}")
+        else:
+            text(client, phone, f"phrase {round_number} {i}")
+
+
+def play_game(client, phones):
+    game_id = start_game(client, phones)
+    for round_number in range(len(phones)):
+        play_round(client, phones, round_number)
+    return game_id
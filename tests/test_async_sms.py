@@ -0,0 +1,109 @@
+"""SMS_ASYNC: /sms acknowledges at once and a shard worker applies the text."""
+
+import pytest
+from helpers import phones_for, start_game, text
+
+import loadgen
+import model
+import outbound
+import tasks
+
+SENDERS = ["+15005550001", "+15005550002"]
+EMPTY_TWIML = '<?xml version="1.0" encoding="UTF-8"?><Response />'
+
+
+def go_async(app):
+    app.config["SMS_ASYNC"] = True
+
+
+@pytest.fixture
+def shards(monkeypatch):
+    """The queue each process_sms was published to, running it eagerly."""
+    queues = []
+    apply = tasks.process_sms.apply
+
+    def apply_async(args=None, queue=None, **options):
+        queues.append(queue)
+        return apply(args)
+
+    monkeypatch.setattr(tasks.process_sms, "apply_async", apply_async)
+    return queues
+
+
+@pytest.fixture
+def sent(fake_twilio, monkeypatch):
+    """(from, to, body) of every message sent through the REST client."""
+    messages = []
+    create = fake_twilio.create
+
+    def recording_create(body=None, from_=None, to=None, **kwargs):
+        messages.append((from_, to, body))
+        return create(body=body, from_=from_, to=to, **kwargs)
+
+    monkeypatch.setattr(fake_twilio, "create", recording_create)
+    return messages
+
+
+def post(client, phone, body, to=None, sid=None):
+    data = {"From": f"+1{phone}", "Body": body}
+    if to:
+        data["To"] = to
+    if sid:
+        data["MessageSid"] = sid
+    response = client.post("/sms", data=data)
+    assert response.status_code == 200
+    return response.get_data(as_text=True)
+
+
+def game_sender(app, game_id):
+    with app.app_context():
+        return model.Game.query.get(game_id).from_number
+
+
+def test_text_is_acknowledged_with_empty_twiml(app, client, sent):
+    go_async(app)
+    assert post(client, "5550000000", "create") == EMPTY_TWIML
+    # the reply went out as its own message instead
+    assert "Game created" in sent[-1][2]
+
+
+def test_reply_goes_out_from_the_games_number(app, client, shards, sent):
+    outbound.scheduler = outbound.OutboundScheduler(SENDERS, 0)
+    phones = phones_for(3)
+    game_id = start_game(client, phones)
+    go_async(app)
+    sender = game_sender(app, game_id)
+    assert sender in SENDERS
+    assert post(client, phones[1], "status", to=sender) == EMPTY_TWIML
+    from_, to, body = sent[-1]
+    assert (from_, to) == (sender, phones[1])
+    assert "waiting on 3 players" in body
+
+
+def test_retried_text_is_applied_once(app, client, shards, sent):
+    phones = phones_for(3)
+    game_id = start_game(client, phones)
+    go_async(app)
+    replies = [
+        post(client, phones[0], "a phrase", sid=f"SM{'c' * 32}") for _ in range(3)
+    ]
+    assert replies == [EMPTY_TWIML] * 3
+    received = [body for _, to, body in sent if to == phones[0] and "Received" in body]
+    assert len(received) == 1
+    with app.app_context():
+        assert model.Game.query.get(game_id).round_responses == 1
+
+
+def test_a_games_texts_share_a_shard(app, client, shards):
+    phones = phones_for(4)
+    game_id = loadgen.JOIN_LINK.search(text(client, phones[0], "create")).group(1)
+    go_async(app)
+    for phone in phones[1:]:
+        post(client, phone, f"join {game_id}")
+    post(client, phones[0], "start")
+    for phone in phones:
+        post(client, phone, f"phrase {phone}")
+    with app.app_context():
+        assert model.Game.query.get(game_id).current_round == 1
+    # JOINs before the players are in the game, then START and the responses
+    assert shards == [tasks.sms_queue(game_id)] * (2 * len(phones))
@@ -0,0 +1,124 @@
+"""Delivery receipts: the buffer, sid matching and re-sends."""
+
+import json
+
+import pytest
+import requests
+from helpers import phones_for, start_game
+
+import delivery
+import model
+import tasks
+import twilio_conf
+from database import db
+
+
+def sid(n):
+    return f"SM{n:032x}"
+
+
+def current_rounds(game_id):
+    game = model.Game.query.get(game_id)
+    return sorted(game.current_rounds, key=lambda r: r.player)
+
+
+def receipt(client, round_id, message_sid, status):
+    response = client.post(
+        f"/sms/status?round_id={round_id}",
+        data={"MessageSid": message_sid, "MessageStatus": status},
+    )
+    assert response.status_code == 204
+
+
+def test_prompt_sids_are_recorded_when_sent(app, client):
+    game_id = start_game(client, phones_for(3))
+    with app.app_context():
+        delivery.flush()
+        sids = [r.prompt_sid for r in current_rounds(game_id)]
+    assert all(delivery.MESSAGE_SID.match(s) for s in sids)
+    assert len(set(sids)) == 3
+
+
+def test_malformed_entries_are_dropped(app, client, redis_client):
+    game_id = start_game(client, phones_for(3))
+    with app.app_context():
+        delivery.flush()
+        rounds = current_rounds(game_id)
+        receipt(client, rounds[0].id, f"{rounds[0].prompt_sid}|failed", "delivered")
+        assert redis_client.llen(delivery.PENDING_KEY) == 0
+        redis_client.rpush(delivery.PENDING_KEY, "not json", json.dumps({"sid": 1}))
+        receipt(client, rounds[1].id, rounds[1].prompt_sid, "delivered")
+        assert delivery.flush() == 3
+        assert redis_client.llen(delivery.PENDING_KEY) == 0
+        db.session.expire_all()
+        statuses = [r.prompt_status for r in current_rounds(game_id)]
+    assert statuses == [None, "delivered", None]
+
+
+def test_receipts_for_a_resent_prompt_are_ignored(app, client):
+    game_id = start_game(client, phones_for(3))
+    with app.app_context():
+        delivery.flush()
+        round = current_rounds(game_id)[0]
+        round_id, old_sid = round.id, round.prompt_sid
+        receipt(client, round_id, old_sid, "undelivered")
+        delivery.flush()
+        assert tasks.resend_undelivered_prompts() == 1
+        # the old message's late receipts don't touch the new one
+        receipt(client, round_id, old_sid, "failed")
+        delivery.flush()
+        db.session.expire_all()
+        round = model.GameRound.query.get(round_id)
+        new_sid = round.prompt_sid
+        assert new_sid not in (old_sid, delivery.AWAITING_SID)
+        assert round.prompt_status is None
+        receipt(client, round_id, new_sid, "delivered")
+        delivery.flush()
+        db.session.expire_all()
+        assert model.GameRound.query.get(round_id).prompt_status == "delivered"
+
+
+@pytest.mark.parametrize("num_players", [3, 6])
+def test_resend_queries_are_fixed(
+    app, client, count_queries, deferred_tasks, num_players
+):
+    game_id = start_game(client, phones_for(num_players))
+    deferred_tasks()
+    with app.app_context():
+        delivery.flush()
+        for round in current_rounds(game_id):
+            receipt(client, round.id, round.prompt_sid, "failed")
+        delivery.flush()
+        sent = twilio_conf.get_client().messages.sent
+        with count_queries() as queries:
+            assert tasks.resend_undelivered_prompts() == num_players
+        deferred_tasks()
+        assert twilio_conf.get_client().messages.sent == sent + num_players
+    assert queries.count == 4
+
+
+def test_a_failed_send_does_not_stop_the_batch(app, client, fake_twilio, monkeypatch):
+    phones = phones_for(3)
+    create = fake_twilio.create
+
+    def create_or_drop(to=None, **kwargs):
+        if to == phones[1]:
+            raise requests.ConnectionError("connection reset")
+        return create(to=to, **kwargs)
+
+    monkeypatch.setattr(fake_twilio, "create", create_or_drop)
+    game_id = start_game(client, phones)
+    with app.app_context():
+        delivery.flush()
+        rounds = current_rounds(game_id)
+        assert [bool(delivery.MESSAGE_SID.match(r.prompt_sid)) for r in rounds] == [
+            True,
+            False,
+            True,
+        ]
+        assert rounds[1].prompt_status == "failed"
+        monkeypatch.setattr(fake_twilio, "create", create)
+        assert tasks.resend_undelivered_prompts() == 1
+        delivery.flush()
+        db.session.expire_all()
+        assert delivery.MESSAGE_SID.match(current_rounds(game_id)[1].prompt_sid)
@@ -0,0 +1,58 @@
+from helpers import phones_for, play_game
+
+import archive
+import gallery
+import loadgen
+import model
+from database import db
+
+
+def gallery_queries(app, client, count_queries, num_players):
+    game_id = play_game(client, phones_for(num_players))
+    with app.app_context():
+        game = model.Game.query.get(game_id)
+        assert game.status == model.Status.COMPLETED
+        gallery._gallery_cache.clear()
+        with count_queries() as queries:
+            chains = gallery.generate_gallery(game)
+    assert len(chains) == num_players
+    assert all(None not in chain for chain in chains)
+    return queries.count
+
+
+def test_gallery_query_count_does_not_grow_with_players(app, client, count_queries):
+    small = gallery_queries(app, client, count_queries, 2)
+    large = gallery_queries(app, client, count_queries, 6)
+    # the archive lookup and the rounds query
+    assert small == large == 2
+
+
+def test_completed_gallery_is_served_from_cache(app, client, count_queries):
+    game_id = play_game(client, phones_for(3))
+    with app.app_context():
+        game = model.Game.query.get(game_id)
+        gallery.generate_gallery(game)
+        with count_queries() as queries:
+            gallery.generate_gallery(game)
+    assert queries.count == 0
+
+
+def test_seeded_history_archives(app):
+    with app.app_context():
+        loadgen.seed_history(db, model, 3, 4)
+        assert archive.backfill(0) == 3
+        for game in model.Game.query:
+            chains = gallery.generate_gallery(game)
+            assert len(chains) == 4
+            assert all(None not in chain for chain in chains)
+
+
+def test_unroutable_rows_are_skipped():
+    routing = model.TurnRouting([[1, 2], [2, 1]])
+    rows = [
+        (1, 0, "word", None, model.TurnType.WRITE),
+        (3, 0, "stranger", None, model.TurnType.WRITE),
+        (2, 5, "late", None, model.TurnType.WRITE),
+    ]
+    chains, _ = gallery.chains_from_rounds(routing, rows)
+    assert chains == [[0, "word", None], [1, None, None]]
@@ -0,0 +1,55 @@
+import random
+
+from helpers import phones_for, text
+
+import game_ids
+import model
+from database import db
+
+
+def test_ids_are_not_reused():
+    ids = {game_ids.allocate()[0] for _ in range(500)}
+    assert len(ids) == 500
+
+
+def test_recycled_ids_have_no_counter_value(redis_client):
+    game_ids.release(["bcdf"])
+    assert game_ids.allocate() == ("bcdf", None)
+    assert game_ids.allocate() == (game_ids.id_for_index(0), 0)
+
+
+def test_create_reseeds_after_counter_is_lost(app, client, redis_client):
+    for phone in phones_for(15, prefix="556"):
+        assert "Game created" in text(client, phone, "create")
+    redis_client.flushall()
+
+    assert "Game created" in text(client, "5570000000", "create")
+    with app.app_context():
+        assert model.Game.query.count() == 16
+    # reseeded past every existing game, so the next one doesn't collide
+    assert int(redis_client.get(game_ids.COUNTER_KEY)) == 16
+
+
+def test_reseed_ignores_ids_from_before_the_counter(app, client, redis_client):
+    rng = random.Random(0)
+    with app.app_context():
+        legacy = {
+            "".join(rng.choice(game_ids.LETTERS) for _ in range(game_ids.ID_LENGTH))
+            for _ in range(200)
+        }
+        # one of them sits where the counter starts
+        legacy.add(game_ids.id_for_index(0))
+        db.session.add_all(model.Game.make(id=id_) for id_ in legacy)
+        db.session.commit()
+
+    assert "Game created" in text(client, "5570000000", "create")
+    assert int(redis_client.get(game_ids.COUNTER_KEY)) == 2
+
+
+def test_reseed_never_moves_the_counter_back(redis_client):
+    redis_client.set(game_ids.COUNTER_KEY, 50)
+    game_ids.reseed(10)
+    game_ids.reseed(None)
+    assert int(redis_client.get(game_ids.COUNTER_KEY)) == 50
+    game_ids.reseed(80)
+    assert int(redis_client.get(game_ids.COUNTER_KEY)) == 81
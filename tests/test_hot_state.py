@@ -0,0 +1,116 @@
+"""Responses recorded in Redis and written behind to the rounds rows."""
+
+import pytest
+from helpers import phones_for, start_game, text
+
+import hot_state
+import model
+import tasks
+
+
+@pytest.fixture(autouse=True)
+def enabled(monkeypatch):
+    monkeypatch.setattr(hot_state, "ENABLED", True)
+
+
+@pytest.fixture
+def flushes(monkeypatch):
+    """Game ids respond() asked to flush because their round was over."""
+    requested = []
+    monkeypatch.setattr(
+        tasks.flush_hot_game,
+        "apply_async",
+        lambda args, **options: requested.append(args[0]),
+    )
+    return requested
+
+
+def round_data(game_id, round_number=0):
+    return {
+        r.player: r.data
+        for r in model.GameRound.query.filter_by(
+            game_id=game_id, round_number=round_number
+        )
+    }
+
+
+def test_first_response_wins(app, client):
+    phones = phones_for(3)
+    game_id = start_game(client, phones)
+    assert hot_state.respond(phones[0], "first", None) == hot_state.RECORDED
+    assert hot_state.respond(phones[0], "second", None) == hot_state.IGNORED
+    with app.app_context():
+        tasks.flush_hot_state()
+        assert "first" in round_data(game_id).values()
+        assert "second" not in round_data(game_id).values()
+
+
+def test_one_response_ends_the_round(client, flushes):
+    phones = phones_for(4)
+    game_id = start_game(client, phones)
+    for phone in phones + phones:
+        hot_state.respond(phone, f"phrase {phone}", None)
+    assert flushes == [game_id]
+
+
+def test_flush_counts_responses_that_went_through_sql(app, client, redis_client):
+    phones = phones_for(3)
+    game_id = start_game(client, phones)
+    for phone in phones[:-1]:
+        assert "Received" in text(client, phone, f"phrase {phone}")
+    # the last player's pointer is gone, so their response falls back to SQL
+    redis_client.delete(hot_state._phone_key(phones[-1]))
+    assert hot_state.respond(phones[-1], "last", None) == hot_state.MISS
+    assert "Received" in text(client, phones[-1], "last")
+    with app.app_context():
+        assert model.Game.query.get(game_id).current_round == 0
+        tasks.flush_hot_state()
+        game = model.Game.query.get(game_id)
+        assert game.current_round == 1
+        assert None not in round_data(game_id).values()
+
+
+def test_response_during_a_flush_leaves_the_game_dirty(app, client, monkeypatch):
+    phones = phones_for(3)
+    game_id = start_game(client, phones)
+    hot_state.respond(phones[0], "before", None)
+    snapshot = hot_state._snapshot
+
+    def snapshot_then_respond(game_id, round_number):
+        taken = snapshot(game_id, round_number)
+        hot_state.respond(phones[1], "during", None)
+        return taken
+
+    with app.app_context():
+        monkeypatch.setattr(hot_state, "_snapshot", snapshot_then_respond)
+        hot_state.flush(game_id)
+        assert hot_state.dirty_games() == {game_id}
+        assert "during" not in round_data(game_id).values()
+        monkeypatch.setattr(hot_state, "_snapshot", snapshot)
+        hot_state.flush(game_id)
+        assert hot_state.dirty_games() == set()
+        assert "during" in round_data(game_id).values()
+
+
+def test_lost_state_is_rebuilt_from_the_database(app, client, redis_client):
+    phones = phones_for(3)
+    game_id = start_game(client, phones)
+    text(client, phones[0], "flushed")
+    with app.app_context():
+        tasks.flush_hot_state()
+    redis_client.flushall()
+
+    assert "Received" in text(client, phones[1], "after the loss")
+    # rebuilt with the flushed response, so a repeat is still ignored
+    assert hot_state.respond(phones[0], "again", None) == hot_state.IGNORED
+    assert len(hot_state.responded(game_id, 0)) == 2
+
+
+def test_evict_leaves_a_moved_pointer_alone(app, client, redis_client):
+    phones = phones_for(3)
+    game_id = start_game(client, phones)
+    redis_client.set(hot_state._phone_key(phones[0]), "OTHR")
+    hot_state.evict(game_id)
+    assert redis_client.get(hot_state._phone_key(phones[0])) == "OTHR"
+    assert redis_client.get(hot_state._phone_key(phones[1])) is None
+    assert not redis_client.exists(hot_state._game_key(game_id))
@@ -0,0 +1,29 @@
+"""Twilio retries of /sms, which repeat the MessageSid."""
+
+from helpers import phones_for, start_game, text
+
+import model
+
+SID = f"SM{'a' * 32}"
+
+
+def test_retried_create_makes_one_game(app, client):
+    replies = [text(client, "5550000000", "create", sid=SID) for _ in range(3)]
+    assert "/join/" in replies[0]
+    assert replies == [replies[0]] * 3
+    with app.app_context():
+        assert model.Game.query.count() == 1
+
+
+def test_retried_response_is_recorded_once(app, client):
+    phones = phones_for(3)
+    game_id = start_game(client, phones)
+    replies = [text(client, phones[0], "a phrase", sid=SID) for _ in range(3)]
+    assert "Received" in replies[0]
+    assert replies == [replies[0]] * 3
+    # a fresh sid is a new text, and the player has already responded
+    assert text(client, phones[0], "a phrase", sid=f"SM{'b' * 32}") != replies[0]
+    with app.app_context():
+        game = model.Game.query.get(game_id)
+        assert game.round_responses == 1
+        assert [r.data for r in game.current_rounds if r.data] == ["a phrase"]
@@ -0,0 +1,125 @@
+import base64
+import http.server
+import os
+import threading
+
+import pytest
+
+import loadgen
+import media
+
+# the real fetch; the autouse fixture swaps in a stand-in
+fetch = media.fetch
+
+
+class MediaHandler(http.server.BaseHTTPRequestHandler):
+    image = loadgen.fake_image()
+    requests = []
+
+    def do_GET(self):
+        self.requests.append((self.path, self.headers.get("Authorization")))
+        if self.path == "/too-large":
+            body = b"x" * (media.MAX_MEDIA_BYTES + 1)
+        else:
+            body = self.image
+        self.send_response(200)
+        self.send_header("Content-Type", "image/png; charset=binary")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def media_server():
+    """A stand-in for Twilio's media host on a local port."""
+    MediaHandler.requests = []
+    httpd = http.server.ThreadingHTTPServer(("127.0.0.1", 0), MediaHandler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{httpd.server_port}"
+    httpd.shutdown()
+    httpd.server_close()
+
+
+@pytest.fixture
+def trust_media_server(monkeypatch):
+    monkeypatch.setattr(media, "is_twilio_media", lambda url: True)
+
+
+def test_fetch_returns_content_and_type(media_server, trust_media_server):
+    content, content_type = fetch(f"{media_server}/drawing")
+    assert content == MediaHandler.image
+    assert content_type == "image/png"
+
+
+def test_fetch_sends_credentials_when_asked(
+    media_server, trust_media_server, monkeypatch
+):
+    monkeypatch.setenv("TWILIO_MEDIA_AUTH", "true")
+    fetch(f"{media_server}/drawing")
+    credentials = (
+        f"{os.environ['TWILIO_ACCOUNT_SID']}:{os.environ['TWILIO_AUTH_TOKEN']}"
+    )
+    assert MediaHandler.requests == [
+        ("/drawing", "Basic " + base64.b64encode(credentials.encode()).decode())
+    ]
+
+
+def test_fetch_stops_at_the_size_limit(media_server, trust_media_server):
+    with pytest.raises(media.MediaTooLarge):
+        fetch(f"{media_server}/too-large")
+
+
+@pytest.mark.parametrize(
+    "url",
+    [
+        "http://api.twilio.com/2010-04-01/Accounts/AC1/Messages/MM1/Media/ME1",
+        "https://api.twilio.com.example.com/Media/ME1",
+        "https://api.twilio.com:8443/Media/ME1",
+        "https://169.254.169.254/latest/meta-data/",
+    ],
+)
+def test_fetch_refuses_other_hosts(url, monkeypatch):
+    monkeypatch.setenv("TWILIO_MEDIA_AUTH", "true")
+    with pytest.raises(media.UntrustedMediaUrl):
+        fetch(url)
+
+
+def test_fetch_refuses_a_local_server(media_server, monkeypatch):
+    monkeypatch.setenv("TWILIO_MEDIA_AUTH", "true")
+    with pytest.raises(media.UntrustedMediaUrl):
+        fetch(f"{media_server}/drawing")
+    assert MediaHandler.requests == []
+
+
+def test_twilio_media_urls_are_trusted():
+    assert media.is_twilio_media(
+        "https://api.twilio.com/2010-04-01/Accounts/AC1/Messages/MM1/Media/ME1"
+    )
+
+
+def test_save_stores_original_and_thumbnail():
+    name = media.save(MediaHandler.image, "image/png")
+    assert media.MEDIA_NAME.match(name)
+    assert os.path.exists(media.path_for(name))
+    assert os.path.exists(media.path_for(media.thumbnail_name(name)))
+
+
+def test_save_writes_nothing_for_non_images():
+    with pytest.raises(OSError):
+        media.save(b"<html>not a drawing</html>", "text/html")
+    assert not os.path.exists(media.MEDIA_ROOT)
+
+
+def test_media_is_served_with_cache_headers(client):
+    name = media.save(MediaHandler.image, "image/png")
+    response = client.get(f"/media/{name}")
+    assert response.status_code == 200
+    assert response.data == MediaHandler.image
+    assert response.headers["Cache-Control"] == f"public, max-age={365 * 24 * 60 * 60}"
+    assert (
+        client.get(f"/media/{name}", headers={"If-None-Match": name}).status_code == 304
+    )
@@ -0,0 +1,127 @@
+import pytest
+import redis
+from helpers import phones_for, text
+
+import loadgen
+import model
+import outbound
+
+NUMBERS = ["+15005550001", "+15005550002", "+15005550003"]
+
+
+class FakeClock:
+    def __init__(self, now=1_000_000.0):
+        self.now = now
+        self.slept = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+def scheduler(clock, redis_client, rate=2, burst=1, numbers=NUMBERS):
+    return outbound.OutboundScheduler(
+        numbers,
+        rate,
+        burst,
+        clock=clock,
+        sleep=clock.sleep,
+        redis_client=redis_client,
+    )
+
+
+def test_sends_are_spaced_at_the_rate(clock, redis_client):
+    pool = scheduler(clock, redis_client, rate=2)
+    assert [pool.reserve(NUMBERS[0]) for _ in range(4)] == [0, 0.5, 1.0, 1.5]
+
+
+def test_burst_goes_out_at_once(clock, redis_client):
+    pool = scheduler(clock, redis_client, rate=2, burst=3)
+    assert [pool.reserve(NUMBERS[0]) for _ in range(4)] == [0, 0, 0, 0.5]
+
+
+def test_bucket_refills_with_time(clock, redis_client):
+    pool = scheduler(clock, redis_client, rate=2)
+    pool.reserve(NUMBERS[0])
+    pool.reserve(NUMBERS[0])
+    clock.now += 10
+    assert pool.reserve(NUMBERS[0]) == 0
+
+
+def test_numbers_have_their_own_buckets(clock, redis_client):
+    pool = scheduler(clock, redis_client, rate=1)
+    assert pool.reserve(NUMBERS[0]) == 0
+    assert pool.reserve(NUMBERS[1]) == 0
+    assert pool.reserve(NUMBERS[0]) == 1
+
+
+def test_wait_sleeps_until_the_slot(clock, redis_client):
+    pool = scheduler(clock, redis_client, rate=4)
+    for _ in range(3):
+        pool.wait(NUMBERS[0])
+    assert clock.slept == [0.25, 0.25]
+
+
+def test_more_senders_shorten_the_wait(clock, redis_client):
+    """Time to send a round's prompts across 30 games falls with the pool."""
+
+    def time_to_send(numbers):
+        clock.now += 3600
+        pool = scheduler(clock, redis_client, rate=1, numbers=numbers)
+        start = clock.now
+        for game in range(30):
+            pool.wait(pool.sender_for(f"G{game:03d}"))
+        return clock.now - start
+
+    assert time_to_send(NUMBERS[:1]) > time_to_send(NUMBERS) > 0
+
+
+def test_sender_is_sticky_and_spread(clock, redis_client):
+    pool = scheduler(clock, redis_client)
+    assert pool.sender_for("ABCD") == pool.sender_for("ABCD")
+    senders = {pool.sender_for(f"G{n:03d}") for n in range(100)}
+    assert senders == set(NUMBERS)
+
+
+def test_no_rate_means_no_waiting(clock, redis_client):
+    pool = scheduler(clock, redis_client, rate=0)
+    assert [pool.wait(NUMBERS[0]) for _ in range(5)] == [0] * 5
+    assert clock.slept == []
+
+
+def test_sends_without_waiting_if_redis_is_down(clock):
+    class Down:
+        def register_script(self, script):
+            def call(**kwargs):
+                raise redis.ConnectionError("down")
+
+            return call
+
+    pool = scheduler(clock, Down())
+    assert pool.reserve(NUMBERS[0]) == 0
+
+
+def test_a_sender_is_required():
+    with pytest.raises(ValueError):
+        outbound.OutboundScheduler([], 1)
+
+
+def test_join_page_gives_the_games_sender(app, client, clock, redis_client):
+    outbound.scheduler = scheduler(clock, redis_client, rate=0)
+    senders = set()
+    for phone in phones_for(6):
+        game_id = loadgen.JOIN_LINK.search(text(client, phone, "create")).group(1)
+        with app.app_context():
+            sender = model.Game.query.get(game_id).sender
+        page = client.get(f"/join/{game_id}").get_data(as_text=True)
+        assert f"sms:{sender}?" in page
+        senders.add(sender)
+    assert len(senders) > 1
@@ -0,0 +1,51 @@
+"""
+Queries per inbound text, as run by the /sms request itself. Tasks it
+publishes are run afterwards, outside the count.
+"""
+
+import pytest
+from helpers import phones_for, text
+
+import loadgen
+
+# the counts mustn't grow with the number of players
+EXPECTED_QUERIES = {
+    "CREATE": 7,
+    "JOIN": 7,
+    "START": 3,
+    "STATUS (cached)": 0,
+    "STATUS": 1,
+    "REPEAT PROMPT": 3,
+    "RESPONSE": 6,
+    "LEAVE": 4,
+}
+
+
+@pytest.mark.parametrize("num_players", [3, 6])
+def test_queries_per_command(
+    client, count_queries, deferred_tasks, redis_client, num_players
+):
+    phones = phones_for(num_players)
+    counts = {}
+
+    def send(command, phone, body):
+        with count_queries() as queries:
+            reply = text(client, phone, body)
+        deferred_tasks()
+        counts[command] = max(counts.get(command, 0), queries.count)
+        return reply
+
+    game_id = loadgen.JOIN_LINK.search(send("CREATE", phones[0], "create")).group(1)
+    for phone in phones[1:]:
+        send("JOIN", phone, f"join {game_id}")
+    send("START", phones[0], "start")
+    send("STATUS (cached)", phones[1], "status")
+    # drop the snapshot so STATUS goes to the database
+    redis_client.flushall()
+    send("STATUS", phones[1], "status")
+    send("REPEAT PROMPT", phones[1], "repeat prompt")
+    for phone in phones[:-1]:
+        assert "Received" in send("RESPONSE", phone, f"phrase from {phone}")
+    send("LEAVE", phones[-1], "leave")
+
+    assert counts == EXPECTED_QUERIES
@@ -0,0 +1,39 @@
+import datetime as dt
+
+from helpers import phones_for, start_game, text
+
+import loadgen
+import model
+import status_cache
+import tasks
+from database import db
+
+
+def idle_since(game_id, hours):
+    game = model.Game.query.get(game_id)
+    game.last_activity_at = dt.datetime.utcnow() - dt.timedelta(hours=hours)
+    db.session.commit()
+
+
+def test_stale_games_are_abandoned(app, client, fake_twilio):
+    stale_phones = phones_for(3)
+    stale = start_game(client, stale_phones)
+    fresh_phones = phones_for(2, prefix="556")
+    fresh = start_game(client, fresh_phones)
+    waiting = loadgen.JOIN_LINK.search(text(client, "5570000000", "create")).group(1)
+    with app.app_context():
+        idle_since(stale, tasks.STALE_GAME_HOURS + 1)
+        idle_since(fresh, tasks.STALE_GAME_HOURS - 1)
+
+        assert tasks.reap_stale_games() == [stale]
+        assert model.Game.query.get(stale).status == model.Status.ABANDONED
+        assert model.Game.query.get(fresh).status == model.Status.IN_PROGRESS
+        assert model.Game.query.get(waiting).status == model.Status.CREATED
+    for phone in stale_phones:
+        assert "nobody played for a while" in fake_twilio.last_sent[phone]
+        assert status_cache.lookup(phone) is None
+    for phone in fresh_phones:
+        assert "nobody played" not in fake_twilio.last_sent[phone]
+
+    # the players are free to start another game
+    assert "Game created" in text(client, stale_phones[0], "create")
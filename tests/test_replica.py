@@ -0,0 +1,81 @@
+import pytest
+from helpers import phones_for, start_game, text
+from sqlalchemy import event
+from sqlalchemy import text as text_clause
+
+import database
+import server
+import status_cache
+
+
+@pytest.fixture
+def app(tmp_path):
+    # the primary's own file stands in for a replica with no lag
+    uri = f"sqlite:///{tmp_path / 'test.db'}"
+    app = server.create_app(
+        {
+            "SQLALCHEMY_DATABASE_URI": uri,
+            "SQLALCHEMY_BINDS": {database.REPLICA_BIND: uri},
+            "TWILIO_VALIDATE_SIGNATURES": False,
+        }
+    )
+    with app.app_context():
+        server.db.create_all()
+    yield app
+    with app.app_context():
+        server.db.engine.dispose()
+
+
+def test_status_from_the_replica_does_not_prime_the_snapshot(app, client, redis_client):
+    phones = phones_for(3)
+    start_game(client, phones)
+    redis_client.flushall()
+
+    assert "waiting on 3 players" in text(client, phones[1], "status")
+    assert status_cache.lookup(phones[1]) is None
+
+
+@pytest.fixture
+def replica_queries(app):
+    """Statements run on the replica."""
+    with app.app_context():
+        replica = server.db.get_engine(bind=database.REPLICA_BIND)
+    queries = []
+
+    def count(*args):
+        queries.append(args[2])
+
+    event.listen(replica, "before_cursor_execute", count)
+    yield queries
+    event.remove(replica, "before_cursor_execute", count)
+
+
+def test_replica_serves_status_reads(app, client, redis_client, replica_queries):
+    phones = phones_for(2)
+    start_game(client, phones)
+    redis_client.flushall()
+    text(client, phones[1], "status")
+    assert len(replica_queries) == 1
+
+
+def test_status_after_a_response_reads_the_primary(
+    app, client, redis_client, replica_queries
+):
+    phones = phones_for(3)
+    game_id = start_game(client, phones)
+    text(client, phones[0], "a phrase")
+    # the snapshot expires, but not the record of the response
+    redis_client.delete(
+        status_cache._phone_key(phones[0]), status_cache._snapshot_key(game_id, 0)
+    )
+
+    assert "waiting on 2 players" in text(client, phones[0], "status")
+    assert replica_queries == []
+    # and a primary read is fresh enough to cache
+    assert status_cache.lookup(phones[0]) == (0, 3, phones[1:])
+
+
+def test_primary_overrides_replica_reads(app, replica_queries):
+    with app.app_context(), database.replica_reads(), database.primary():
+        server.db.session.execute(text_clause("SELECT 1"))
+    assert replica_queries == []
@@ -0,0 +1,97 @@
+"""
+Simultaneous responses to one game. Runs against DATABASE_PATH's engine when
+TEST_DATABASE_PATH is set (e.g. to a Postgres scratch database), where the
+game row lock is what keeps the count right, and SQLite otherwise.
+"""
+
+import os
+import threading
+
+import pytest
+from helpers import phones_for, start_game, text
+
+import model
+import server
+import tasks
+
+pytestmark = pytest.mark.usefixtures("hot_state_modes")
+
+
+@pytest.fixture
+def app(tmp_path):
+    uri = os.environ.get("TEST_DATABASE_PATH") or f"sqlite:///{tmp_path / 'test.db'}"
+    app = server.create_app(
+        {"SQLALCHEMY_DATABASE_URI": uri, "TWILIO_VALIDATE_SIGNATURES": False}
+    )
+    with app.app_context():
+        server.db.drop_all()
+        server.db.create_all()
+    yield app
+    with app.app_context():
+        server.db.drop_all()
+        server.db.engine.dispose()
+
+
+def respond_at_once(app, phones, body):
+    """Post a response from every phone at the same moment, one thread each."""
+    barrier = threading.Barrier(len(phones))
+    replies = {}
+
+    def respond(phone):
+        client = app.test_client()
+        barrier.wait()
+        replies[phone] = text(client, phone, f"{body} {phone}")
+
+    threads = [threading.Thread(target=respond, args=(p,)) for p in phones]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return replies
+
+
+@pytest.mark.parametrize("num_players", [4, 8])
+def test_simultaneous_responses_end_the_round_once(
+    app, client, monkeypatch, num_players
+):
+    phones = phones_for(num_players)
+    game_id = start_game(client, phones)
+    transitions = []
+    monkeypatch.setattr(
+        tasks.start_new_round, "delay", lambda game_id: transitions.append(game_id)
+    )
+
+    replies = respond_at_once(app, phones, "phrase")
+
+    assert all("Received" in reply for reply in replies.values())
+    assert transitions == [game_id]
+    with app.app_context():
+        game = model.Game.query.get(game_id)
+        assert game.current_round == 1
+        assert game.round_responses == 0
+        assert (
+            model.GameRound.query.filter_by(game_id=game_id, round_number=0)
+            .filter(model.GameRound.data.isnot(None))
+            .count()
+            == num_players
+        )
+
+
+def test_repeated_simultaneous_responses_count_once(app, client, monkeypatch):
+    phones = phones_for(4)
+    game_id = start_game(client, phones)
+    transitions = []
+    monkeypatch.setattr(
+        tasks.start_new_round, "delay", lambda game_id: transitions.append(game_id)
+    )
+
+    # every player but the last sends their response twice at once
+    respond_at_once(app, phones[:-1] * 2, "phrase")
+    with app.app_context():
+        # written behind when responses go through hot_state
+        tasks.flush_hot_state()
+        assert model.Game.query.get(game_id).round_responses == 3
+    assert transitions == []
+
+    text(client, phones[-1], "the last phrase")
+    assert transitions == [game_id]
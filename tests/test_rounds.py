@@ -0,0 +1,39 @@
+from helpers import phones_for, play_round, start_game
+from sqlalchemy.orm.attributes import set_committed_value
+
+import model
+import tasks
+
+
+def round_rows(game_id, round_number):
+    return model.GameRound.query.filter_by(
+        game_id=game_id, round_number=round_number
+    ).count()
+
+
+def test_starting_a_round_twice_creates_it_once(app, client, fake_twilio):
+    phones = phones_for(3)
+    game_id = start_game(client, phones)
+    play_round(client, phones, 0)
+    sent = fake_twilio.sent
+    with app.app_context():
+        tasks.start_new_round(game_id)
+        assert round_rows(game_id, 1) == 3
+    # nor are the prompts sent again
+    assert fake_twilio.sent == sent
+
+
+def test_concurrent_round_creation_is_rejected(app, client):
+    phones = phones_for(3)
+    game_id = start_game(client, phones)
+    play_round(client, phones, 0)
+    with app.app_context():
+        game = model.Game.query.get(game_id)
+        # as loaded by a start that raced the one that created the round
+        set_committed_value(game, "current_rounds", [])
+        rounds = [
+            model.GameRound(game_id=game_id, player=p.id, round_number=1)
+            for p in game.players
+        ]
+        assert tasks.create_rounds(game, rounds) is None
+        assert round_rows(game_id, 1) == 3
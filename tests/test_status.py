@@ -0,0 +1,43 @@
+import pytest
+from helpers import phones_for, start_game, text
+
+import status_cache
+import tasks
+
+pytestmark = pytest.mark.usefixtures("hot_state_modes")
+
+
+def test_lookup_after_prime():
+    status_cache.prime("GAME", 0, ["1", "2", "3"])
+    status_cache.record_response("GAME", 0, "2")
+    assert status_cache.lookup("1") == (0, 3, ["1", "3"])
+
+
+def test_rebuild_from_older_rows_keeps_a_response():
+    # a response commits while another request rebuilds the missing snapshot
+    # from rows it read before that
+    status_cache.record_response("GAME", 0, "2")
+    status_cache.prime("GAME", 0, ["1", "2", "3"], ["1", "2"], only_if_missing=True)
+    assert status_cache.lookup("1") == (0, 3, ["1"])
+
+
+def test_rebuild_leaves_a_live_snapshot_alone():
+    status_cache.prime("GAME", 0, ["1", "2", "3"])
+    status_cache.prime("GAME", 0, ["1", "2", "3"], ["3"], only_if_missing=True)
+    assert status_cache.lookup("1") == (0, 3, ["1", "2", "3"])
+
+
+def test_status_after_the_snapshot_expires(app, client, redis_client):
+    phones = phones_for(3)
+    start_game(client, phones)
+    text(client, phones[0], "first phrase")
+    with app.app_context():
+        # as the periodic flush does long before anything expires
+        tasks.flush_hot_state()
+    redis_client.flushall()
+
+    reply = text(client, phones[1], "status")
+    assert "waiting on 2 players" in reply
+    text(client, phones[1], "second phrase")
+    # answered from the rebuilt snapshot
+    assert status_cache.lookup(phones[0]) == (0, 3, [phones[2]])
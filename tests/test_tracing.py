@@ -0,0 +1,61 @@
+"""A text's trace followed through the Celery tasks it sets off."""
+
+import uuid
+
+import pytest
+from celery.app.task import Task
+from celery.app.trace import build_tracer
+from celery.signals import before_task_publish
+from helpers import phones_for, play_round, start_game, text
+
+import tracing
+
+
+@pytest.fixture
+def published(app, monkeypatch):
+    """
+    Hold published tasks along with the headers publishing gave them, and run
+    them on run() as a worker would, with those headers on the request.
+    """
+    pending = []
+
+    def apply_async(self, args=None, kwargs=None, **options):
+        headers = {}
+        before_task_publish.send(sender=self.name, headers=headers)
+        pending.append((self, args or (), kwargs or {}, headers))
+
+    monkeypatch.setattr(Task, "apply_async", apply_async)
+
+    def run():
+        ran = []
+        with app.app_context():
+            while pending:
+                task, args, kwargs, headers = pending.pop(0)
+                task_id = uuid.uuid4().hex
+                request = {"id": task_id, "delivery_info": {}, **headers}
+                build_tracer(task.name, task, propagate=True, app=task.app)(
+                    task_id, args, kwargs, request
+                )
+                ran.append(task.name)
+        return ran
+
+    return run
+
+
+def test_round_transition_is_traced_through_its_tasks(client, published):
+    phones = phones_for(3)
+    game_id = start_game(client, phones)
+    published()
+    play_round(client, phones[:-1], 0)
+    published()
+
+    text(client, phones[-1], "the last phrase")
+    ran = published()
+    assert "tasks.start_new_round" in ran
+    assert "tasks.send_sms_batch" in ran
+
+    (trace,) = tracing.game_traces(game_id, transitions_only=True)
+    assert trace["transition"] == 1
+    tasks_traced = {s.get("task") for s in trace["spans"] if s["name"] == "task"}
+    assert {"tasks.start_new_round", "tasks.send_sms_batch"} <= tasks_traced
+    assert {"webhook", "queue_wait", "twilio"} <= set(trace["stages"])
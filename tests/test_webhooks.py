@@ -0,0 +1,71 @@
+import os
+
+import pytest
+from twilio.request_validator import RequestValidator
+
+import server
+
+
+@pytest.fixture
+def signed_app(app):
+    app.config["TWILIO_VALIDATE_SIGNATURES"] = True
+    return app
+
+
+def sign(url, form):
+    return RequestValidator(os.environ["TWILIO_AUTH_TOKEN"]).compute_signature(
+        url, form
+    )
+
+
+FORM = {"From": "+15550000001", "Body": "status", "MessageSid": "SM" + "1" * 32}
+
+
+def test_signed_text_is_handled(signed_app):
+    url = os.environ["EIP"] + "/sms"
+    response = signed_app.test_client().post(
+        "/sms", data=FORM, headers={"X-Twilio-Signature": sign(url, FORM)}
+    )
+    assert response.status_code == 200
+    assert "not playing a game" in response.get_data(as_text=True)
+
+
+@pytest.mark.parametrize("signature", [None, "forged"])
+def test_unsigned_text_is_rejected(signed_app, signature):
+    headers = {"X-Twilio-Signature": signature} if signature else {}
+    response = signed_app.test_client().post("/sms", data=FORM, headers=headers)
+    assert response.status_code == 403
+
+
+def test_signature_covers_the_status_callback_query(signed_app):
+    form = {"MessageSid": "SM" + "2" * 32, "MessageStatus": "delivered"}
+    client = signed_app.test_client()
+    signature = sign(os.environ["EIP"] + "/sms/status?round_id=1", form)
+    ok = client.post(
+        "/sms/status?round_id=1", data=form, headers={"X-Twilio-Signature": signature}
+    )
+    assert ok.status_code == 204
+    moved = client.post(
+        "/sms/status?round_id=2", data=form, headers={"X-Twilio-Signature": signature}
+    )
+    assert moved.status_code == 403
+
+
+def test_signature_covers_the_proxied_url(signed_app, monkeypatch):
+    monkeypatch.delenv("EIP")
+    url = "https://games.example.com/sms"
+    response = signed_app.test_client().post(
+        "/sms",
+        data=FORM,
+        headers={
+            "X-Twilio-Signature": sign(url, FORM),
+            "X-Forwarded-Proto": "https",
+            "Host": "games.example.com",
+        },
+    )
+    assert response.status_code == 200
+
+
+def test_signatures_are_not_checked_by_default(monkeypatch):
+    monkeypatch.delenv("TWILIO_VALIDATE_SIGNATURES", raising=False)
+    assert not server.create_app().config["TWILIO_VALIDATE_SIGNATURES"]
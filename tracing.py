@@ -0,0 +1,140 @@
+"""
+Per-game traces of inbound texts and the work they set off.
+
+Each /sms request starts a trace whose id and context are carried in the
+headers of every Celery task it publishes, and on down to the tasks those
+publish, so a round transition can be followed from the final response
+through start_new_round to each Twilio call. Spans (webhook, queue wait, task,
+db, rate-limit wait, twilio) are buffered in-process and flushed to Redis with
+the metrics, and GET /traces/<game_id> returns a game's recent traces with
+time per stage. Like /metrics it is only served to the host itself.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+import redis
+
+from store import get_redis
+
+logger = logging.getLogger(__name__)
+
+TRACE_TTL = int(os.environ.get("TRACE_TTL", 7 * 24 * 60 * 60))
+TRACES_PER_GAME = 200
+
+_trace = ContextVar("trace", default=None)
+_pending = []
+_pending_lock = threading.Lock()
+
+
+def start(trace_id=None):
+    """Begin a new trace, returning a token for end()."""
+    return _trace.set(
+        {"id": trace_id or uuid.uuid4().hex[:16], "started_at": time.time()}
+    )
+
+
+def resume(context):
+    """Continue a trace passed along in task headers."""
+    return _trace.set(dict(context))
+
+
+def end(token):
+    _trace.reset(token)
+
+
+def current():
+    return _trace.get()
+
+
+def tag(**attrs):
+    """Attach attributes (game_id, transition) to the current trace."""
+    trace = _trace.get()
+    if trace is not None:
+        trace.update(attrs)
+
+
+def record(name, start_time, seconds, **attrs):
+    trace = _trace.get()
+    if trace is None:
+        return
+    span = {"name": name, "start": start_time, "seconds": seconds, **attrs}
+    with _pending_lock:
+        _pending.append((dict(trace), span))
+
+
+@contextmanager
+def span(name, **attrs):
+    start_time = time.time()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, start_time, time.perf_counter() - start, **attrs)
+
+
+def flush():
+    global _pending
+    with _pending_lock:
+        pending, _pending = _pending, []
+    if not pending:
+        return
+    try:
+        pipe = get_redis().pipeline(transaction=False)
+        for trace, span in pending:
+            key = f"trace:{trace['id']}"
+            pipe.rpush(f"{key}:spans", json.dumps(span))
+            pipe.hset(key, mapping={k: json.dumps(v) for k, v in trace.items()})
+            pipe.expire(f"{key}:spans", TRACE_TTL)
+            pipe.expire(key, TRACE_TTL)
+            if trace.get("game_id"):
+                game_key = f"traces:game:{trace['game_id']}"
+                pipe.zadd(game_key, {trace["id"]: trace["started_at"]})
+                pipe.zremrangebyrank(game_key, 0, -TRACES_PER_GAME - 1)
+                pipe.expire(game_key, TRACE_TTL)
+        pipe.execute()
+    except redis.RedisError:
+        logger.exception("could not flush trace spans")
+
+
+def load(trace_id):
+    client = get_redis()
+    trace = {k: json.loads(v) for k, v in client.hgetall(f"trace:{trace_id}").items()}
+    spans = [json.loads(s) for s in client.lrange(f"trace:{trace_id}:spans", 0, -1)]
+    if not trace:
+        return None
+    stages = defaultdict(float)
+    for s in spans:
+        stages[s["name"]] += s["seconds"]
+    end_time = max((s["start"] + s["seconds"] for s in spans), default=None)
+    return {
+        **trace,
+        "total_seconds": end_time - trace["started_at"] if end_time else 0,
+        "stages": dict(stages),
+        "spans": sorted(spans, key=lambda s: s["start"]),
+    }
+
+
+def game_traces(game_id, transitions_only=False):
+    """A game's traces, oldest first."""
+    trace_ids = get_redis().zrange(f"traces:game:{game_id}", 0, -1)
+    traces = [trace for trace in map(load, trace_ids) if trace]
+    if transitions_only:
+        traces = [trace for trace in traces if "transition" in trace]
+    return traces
+
+
+def init_app(app):
+    from flask import jsonify, request
+
+    @app.route("/traces/<game_id>")
+    def show_traces(game_id):
+        transitions_only = request.args.get("transitions") == "1"
+        return jsonify(game_id=game_id, traces=game_traces(game_id, transitions_only))
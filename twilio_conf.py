@@ -1,12 +1,47 @@
 import os
 
 from dotenv import load_dotenv
-from twilio.rest import Client
 
 load_dotenv()
 
 
-twilio_num = os.environ["TWILIO_NUMBER"]
-account_sid = os.environ["TWILIO_ACCOUNT_SID"]
-auth_token = os.environ["TWILIO_AUTH_TOKEN"]
-client = Client(account_sid, auth_token)
+twilio_num = os.environ.get("TWILIO_NUMBER")
+
+# Pool of numbers games are sent from (see outbound.py), comma separated. Every
+# number's inbound webhook should point at /sms. Defaults to TWILIO_NUMBER.
+twilio_numbers = [
+    n.strip()
+    for n in os.environ.get("TWILIO_NUMBERS", twilio_num or "").split(",")
+    if n.strip()
+]
+# Messages per second each number may send, and how many may go out at once
+# after a quiet spell. A US long code manages about 1 per second.
+sender_rate = float(os.environ.get("TWILIO_SENDER_RATE", 1))
+sender_burst = int(os.environ.get("TWILIO_SENDER_BURST", 1))
+
+# Number of concurrent Twilio requests a worker makes when fanning out a batch.
+# The HTTP session keeps the same number of connections alive for reuse.
+sms_pool_size = int(os.environ.get("SMS_POOL_SIZE", 8))
+
+# Built on first use so importing this module doesn't pull in the Twilio REST
+# client; assign a stand-in here to replace it.
+client = None
+
+
+def get_client():
+    global client
+    if client is None:
+        from requests.adapters import HTTPAdapter
+        from twilio.http.http_client import TwilioHttpClient
+        from twilio.rest import Client
+
+        http_client = TwilioHttpClient(pool_connections=True)
+        http_client.session.mount(
+            "https://", HTTPAdapter(pool_connections=1, pool_maxsize=sms_pool_size)
+        )
+        client = Client(
+            os.environ["TWILIO_ACCOUNT_SID"],
+            os.environ["TWILIO_AUTH_TOKEN"],
+            http_client=http_client,
+        )
+    return client